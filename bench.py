@@ -0,0 +1,234 @@
+"""
+Local latency benchmark for the bot.
+
+Starts a stand-in for the Ooredoo API on localhost, points ooredoo.py at it and
+drives the real handlers (start, handle_msg, refresh_dashboard, claim_gift) with
+fake Telegram updates from N concurrent simulated users.
+
+    python bench.py --users 50 --iterations 20 --latency 80 --jitter 40
+    python bench.py --scenario claim --error-rate 0.05 --bundles 40
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime as dt_class
+from email.utils import formatdate
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlsplit
+
+
+# --- MOCK OOREDOO API ---
+class MockOoredoo:
+    """Minimal keep-alive HTTP/1.1 server answering the seven URL_* endpoints."""
+
+    def __init__(self, latency_ms=50, jitter_ms=0, error_rate=0.0, bundles=4):
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.error_rate = error_rate
+        self.bundles = bundles
+        self.calls = {}
+        self.port = None
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, "127.0.0.1", 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _serve(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line: break
+                method, target, _ = line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    h = await reader.readline()
+                    if h in (b"\r\n", b"\n", b""): break
+                    k, _, v = h.decode("latin-1").partition(":")
+                    headers[k.strip().lower()] = v.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0) or 0))
+                status, extra, payload = await self._route(method, target, body)
+                data = json.dumps(payload).encode() if payload is not None else b""
+                head = [f"HTTP/1.1 {status} X", f"Date: {formatdate(usegmt=True)}",
+                        "Content-Type: application/json", f"Content-Length: {len(data)}"]
+                head += [f"{k}: {v}" for k, v in extra.items()]
+                writer.write(("\r\n".join(head) + "\r\n\r\n").encode() + data)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _route(self, method, target, body):
+        path = urlsplit(target).path
+        name = path.rsplit("/", 1)[-1]
+        self.calls[name] = self.calls.get(name, 0) + 1
+        await asyncio.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+        if random.random() < self.error_rate:
+            return 503, {}, {"error": "unavailable"}
+
+        if name == "token" and "checkpoint" in path:
+            return 202, {"X-Nonce-Id": uuid.uuid4().hex, "X-Chronos-Id": str(int(time.time() * 1000))}, None
+        if name == "token":
+            form = {k: v[0] for k, v in parse_qs(body.decode()).items()}
+            if form.get("grant_type") == "password" and "otp" not in form:
+                return 403, {}, {"error": "otp_required"}
+            return 200, {}, {"access_token": uuid.uuid4().hex, "refresh_token": uuid.uuid4().hex, "expires_in": 3600}
+        if name == "validateUser":
+            return 200, {}, {"planType": "YOOZ"}
+        if name == "status":
+            return 200, {}, {"played": False}
+        if name == "play":
+            return 200, {}, {"giftName": "1 GB", "validityHour": 24, "playedTime": dt_class.now().isoformat()}
+        if name == "getActivePackages":
+            names = ["DATA", "YOUTUBE", "VOICE", "SMS", "OTHER"]
+            bundles = [{"allocationName": names[i % len(names)], "remainingBalance": str(i * 10), "unit": "MB",
+                        "expireDate": "2030-01-01T00:00:00.000"} for i in range(self.bundles)]
+            return 200, {}, {"accountBalance": "150.00", "activeBundles": bundles[: self.bundles // 2],
+                             "monthlyDataSmartBundlePurchases": {"dataBundles": bundles[self.bundles // 2:]}}
+        if name == "eligibility":
+            return 200, {}, {"eligible": True}
+        return 404, {}, {"error": "not found"}
+
+
+# --- FAKE TELEGRAM ---
+class FakeTelegram:
+    """Counts outgoing Bot API calls and adds a fixed delay to each."""
+
+    def __init__(self, latency_ms=0):
+        self.latency = latency_ms / 1000
+        self.calls = 0
+
+    async def call(self, *args, **kwargs):
+        self.calls += 1
+        if self.latency: await asyncio.sleep(self.latency)
+        return SimpleNamespace(message_id=self.calls, chat=None, edit_text=self.call)
+
+
+def make_update(tg, chat_id, text=None, data=None):
+    chat = SimpleNamespace(id=chat_id, send_message=tg.call)
+    message = SimpleNamespace(text=text, chat=chat, reply_text=tg.call, edit_text=tg.call)
+    query = None
+    if data is not None:
+        query = SimpleNamespace(data=data, message=message, answer=tg.call, edit_message_text=tg.call)
+    return SimpleNamespace(update_id=random.getrandbits(31), effective_chat=chat, effective_user=chat,
+                           message=None if query else message, effective_message=message, callback_query=query)
+
+
+# --- RUNNER ---
+def percentile(samples, p):
+    if not samples: return 0.0
+    ordered = sorted(samples)
+    k = min(len(ordered) - 1, max(0, int(round(p / 100 * (len(ordered) - 1)))))
+    return ordered[k]
+
+
+async def run(args):
+    mock = MockOoredoo(args.latency, args.jitter, args.error_rate, args.bundles)
+    await mock.start()
+
+    os.environ.update({
+        "TELEGRAMBOTTOKEN": "0:bench",
+        "DBNAME": os.path.join(tempfile.mkdtemp(prefix="ooredoo-bench-"), "botusers.db"),
+        "OOREDOO_API_BASE": f"http://127.0.0.1:{mock.port}",
+        "HEALTH_PORT": "0",
+        "GIFT_NOTIFY": "0",
+    })
+    if args.no_cache:
+        os.environ["DASH_CACHE_TTL"] = "0"
+    if args.unthrottled:
+        os.environ.update({"UPSTREAM_RATE": "1e9", "UPSTREAM_BURST": "1e9"})
+    import ooredoo
+
+    ooredoo.logger.setLevel("WARNING")
+    ooredoo.init_db()
+    app = SimpleNamespace(bot=None)
+    await ooredoo.on_startup(app)
+    tg = FakeTelegram(args.tg_latency)
+    timings = {}
+    errors = {}
+    failed_logins = 0
+
+    async def timed(name, handler, update):
+        t0 = time.perf_counter()
+        try:
+            await handler(update, None)
+        except Exception as e:
+            # Counted rather than raised so one bad handler call does not abort the run.
+            key = f"{name}: {type(e).__name__}"
+            errors[key] = errors.get(key, 0) + 1
+        timings.setdefault(name, []).append(time.perf_counter() - t0)
+
+    async def login(chat_id):
+        await timed("start", ooredoo.start, make_update(tg, chat_id, text="/start"))
+        await timed("handle_msg:phone", ooredoo.handle_msg, make_update(tg, chat_id, text=f"05{chat_id:08d}"))
+        await timed("handle_msg:otp", ooredoo.handle_msg, make_update(tg, chat_id, text="123456"))
+
+    async def user(chat_id):
+        nonlocal failed_logins
+        await login(chat_id)
+        u = await ooredoo.get_user_data(chat_id)
+        if not u or not u.access_token:
+            failed_logins += 1
+            return
+        for _ in range(args.iterations):
+            if args.scenario in ("dashboard", "mixed"):
+                await timed("refresh_dashboard", ooredoo.refresh_dashboard, make_update(tg, chat_id, data="refresh_dash"))
+            if args.scenario in ("claim", "mixed"):
+                await timed("claim_gift", ooredoo.claim_gift, make_update(tg, chat_id, data="claim_gift"))
+            if args.think:
+                await asyncio.sleep(random.uniform(0, args.think / 1000))
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(user(1000 + i) for i in range(args.users)))
+    wall = time.perf_counter() - t0
+
+    await ooredoo.on_shutdown(app)
+    await mock.stop()
+
+    total = sum(len(v) for v in timings.values())
+    print(f"users={args.users} iterations={args.iterations} scenario={args.scenario} "
+          f"upstream={args.latency}±{args.jitter}ms errors={args.error_rate:.0%} bundles={args.bundles}")
+    print(f"{'handler':<20}{'n':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'mean ms':>10}")
+    for name, samples in timings.items():
+        ms = [x * 1000 for x in samples]
+        print(f"{name:<20}{len(ms):>7}{percentile(ms, 50):>10.1f}{percentile(ms, 95):>10.1f}"
+              f"{percentile(ms, 99):>10.1f}{statistics.fmean(ms):>10.1f}")
+    print(f"throughput: {total / wall:.1f} handler calls/s over {wall:.2f}s")
+    print(f"upstream calls: {sum(mock.calls.values())} {dict(sorted(mock.calls.items()))}")
+    print(f"telegram calls: {tg.calls}")
+    if failed_logins or errors:
+        print(f"failed logins: {failed_logins}/{args.users} handler errors: {errors or 0}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20, help="concurrent simulated users")
+    parser.add_argument("--iterations", type=int, default=10, help="scenario repetitions per user")
+    parser.add_argument("--scenario", choices=["dashboard", "claim", "mixed"], default="mixed")
+    parser.add_argument("--latency", type=float, default=50, help="mean upstream latency (ms)")
+    parser.add_argument("--jitter", type=float, default=20, help="upstream latency jitter (ms)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of upstream calls answering 503")
+    parser.add_argument("--bundles", type=int, default=4, help="bundles in each getActivePackages payload")
+    parser.add_argument("--tg-latency", type=float, default=0, help="delay added to each Telegram call (ms)")
+    parser.add_argument("--think", type=float, default=0, help="max random pause between iterations (ms)")
+    parser.add_argument("--no-cache", action="store_true", help="disable the dashboard result cache")
+    parser.add_argument("--unthrottled", action="store_true", help="lift the per-endpoint upstream rate limit")
+    args = parser.parse_args()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,40 @@
 import logging
-import requests
+import asyncio
+import httpx
 import json
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup 
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters 
+from telegram.ext import Application, BaseUpdateProcessor, CommandHandler, MessageHandler, CallbackQueryHandler, filters 
 import sys 
 import time 
 import hashlib 
 import hmac 
+import heapq
 import sqlite3 
 import datetime 
 import uuid 
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import os
 DBNAME = os.environ.get("DBNAME", "/data/botusers.db")
 import os
 TELEGRAMBOTTOKEN = os.environ["TELEGRAMBOTTOKEN"]
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "telegram")
+PORT = int(os.environ.get("PORT", "8080"))
+# Telegram echoes this in X-Telegram-Bot-Api-Secret-Token; defaults to a value derived from the bot token.
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET") or hashlib.sha256(TELEGRAMBOTTOKEN.encode()).hexdigest()
 import base64
 import random
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
 from datetime import datetime as dt_class
 
 # --- CONFIGURATION ---
@@ -30,36 +49,520 @@ formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(messag
 console_handler.setFormatter(formatter)
 logger.addHandler(console_handler)
 
+# --- METRICS ---
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _labels(names, values):
+    if not names: return ""
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, values)) + "}"
+
+class Histogram:
+    def __init__(self, name, doc, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name, self.doc, self.labelnames, self.buckets = name, doc, labelnames, buckets
+        self.series = {}
+        self._lock = threading.Lock()  # also observed from the SQLite worker thread
+
+    def observe(self, value, *labels):
+        with self._lock:
+            s = self.series.get(labels)
+            if s is None:
+                s = self.series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound: s[0][i] += 1
+            s[1] += value
+            s[2] += 1
+
+    def time(self, *labels):
+        return _Timer(self, labels)
+
+    def render(self):
+        out = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, (counts, total, n) in self.series.items():
+                for bound, c in zip(self.buckets, counts):
+                    out.append(f"{self.name}_bucket{_labels(self.labelnames + ('le',), labels + (bound,))} {c}")
+                out.append(f"{self.name}_bucket{_labels(self.labelnames + ('le',), labels + ('+Inf',))} {n}")
+                out.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {total}")
+                out.append(f"{self.name}_count{_labels(self.labelnames, labels)} {n}")
+        return out
+
+class _Timer:
+    __slots__ = ('hist', 'labels', 'start')
+
+    def __init__(self, hist, labels):
+        self.hist, self.labels = hist, labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.hist.observe(time.perf_counter() - self.start, *self.labels)
+
+class Counter:
+    def __init__(self, name, doc, labelnames=()):
+        self.name, self.doc, self.labelnames = name, doc, labelnames
+        self.values = {}
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        out = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} counter"]
+        out += [f"{self.name}{_labels(self.labelnames, k)} {v}" for k, v in self.values.items()]
+        return out
+
+class CallbackMetric:
+    """Gauge or counter whose samples are read from live objects at scrape time."""
+
+    def __init__(self, name, doc, kind, labelnames, collect):
+        self.name, self.doc, self.kind, self.labelnames, self.collect = name, doc, kind, labelnames, collect
+
+    def render(self):
+        out = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}"]
+        out += [f"{self.name}{_labels(self.labelnames, k)} {v}" for k, v in self.collect()]
+        return out
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for m in self.metrics:
+            try:
+                lines += m.render()
+            except Exception as e:
+                logger.warning(f"Metric {m.name} failed to render: {e}")
+        return ("\n".join(lines) + "\n").encode()
+
+metrics = MetricsRegistry()
+HANDLER_SECONDS = metrics.add(Histogram("ooredoo_handler_seconds", "Telegram handler latency.", ("handler",)))
+HANDLER_ERRORS = metrics.add(Counter("ooredoo_handler_errors_total", "Telegram handlers that raised.", ("handler",)))
+UPSTREAM_SECONDS = metrics.add(Histogram("ooredoo_upstream_seconds", "Upstream call latency per attempt.", ("endpoint",)))
+UPSTREAM_RESPONSES = metrics.add(Counter("ooredoo_upstream_responses_total", "Upstream responses by status.", ("endpoint", "status")))
+SQLITE_SECONDS = metrics.add(Histogram("ooredoo_sqlite_seconds", "SQLite work time on the DB thread.", ("op",)))
+LOOP_LAG_SECONDS = metrics.add(Histogram("ooredoo_event_loop_lag_seconds", "Event loop scheduling lag.", (),
+                                         (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)))
+
+def instrumented(handler):
+    """Records latency and failures of a Telegram handler."""
+    name = handler.__name__
+
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        start = time.perf_counter()
+        try:
+            return await handler(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - start, name)
+    return wrapper
+
+class LoopLagMonitor:
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self._task = None
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            LOOP_LAG_SECONDS.observe(max(0.0, time.perf_counter() - start - self.interval))
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+loop_lag = LoopLagMonitor()
+
 # --- DATABASE ---
-def init_db():
-    conn = sqlite3.connect(DBNAME)
-    cursor = conn.cursor()
-    cursor.execute('''
+USER_COLUMNS = ('phone_number', 'access_token', 'refresh_token', 'token_expires_in', 'last_updated',
+                'device_uuid', 'instant_id', 'plan_type', 'last_played_time', 'token_expires_at')
+
+SQL_GET_USER = f"SELECT {', '.join(USER_COLUMNS)} FROM users WHERE chat_id=?"
+SQL_GET_USERS = f"SELECT chat_id, {', '.join(USER_COLUMNS)} FROM users WHERE chat_id IN ({{}})"
+SQL_TOKEN_EXPIRIES = (
+    "SELECT chat_id, token_expires_at, token_expires_in FROM users "
+    "WHERE token_expires_at IS NOT NULL AND refresh_token IS NOT NULL ORDER BY token_expires_at"
+)
+SQL_RECENT_PLAYED = (
+    "SELECT chat_id, last_played_time FROM users "
+    "WHERE last_played_time >= ? AND access_token IS NOT NULL"
+)
+SQL_GET_STATE = "SELECT state FROM conversation_states WHERE chat_id=? AND expires_at>?"
+SQL_UPSERT_STATE = (
+    "INSERT INTO conversation_states (chat_id, state, expires_at) VALUES (?,?,?) "
+    "ON CONFLICT(chat_id) DO UPDATE SET state=excluded.state, expires_at=excluded.expires_at"
+)
+SQL_DELETE_STATE = "DELETE FROM conversation_states WHERE chat_id=?"
+SQL_PURGE_STATES = "DELETE FROM conversation_states WHERE expires_at<=?"
+SQL_CAP_STATES = (
+    "DELETE FROM conversation_states WHERE chat_id IN (SELECT chat_id FROM conversation_states "
+    "ORDER BY expires_at LIMIT max(0, (SELECT COUNT(*) FROM conversation_states) - ?))"
+)
+SQL_SWEEP_BATCH = (
+    "SELECT chat_id, phone_number, access_token, instant_id FROM users "
+    "WHERE chat_id>? AND access_token IS NOT NULL ORDER BY chat_id LIMIT ?"
+)
+SQL_SWEEP_GET = "SELECT last_chat_id, processed, failed, expired FROM sweep_progress WHERE name=?"
+SQL_SWEEP_SAVE = (
+    "INSERT INTO sweep_progress (name, last_chat_id, processed, failed, expired, updated_at) VALUES (?,?,?,?,?,?) "
+    "ON CONFLICT(name) DO UPDATE SET last_chat_id=excluded.last_chat_id, processed=excluded.processed, "
+    "failed=excluded.failed, expired=excluded.expired, updated_at=excluded.updated_at"
+)
+SQL_SWEEP_DELETE = "DELETE FROM sweep_progress WHERE name=?"
+SQL_GET_DEVICE = "SELECT device_uuid, instant_id FROM users WHERE chat_id=?"
+SQL_UPSERT_DEVICE = (
+    "INSERT INTO users (chat_id, device_uuid, instant_id, last_updated) VALUES (?,?,?,?) "
+    "ON CONFLICT(chat_id) DO UPDATE SET device_uuid=excluded.device_uuid, instant_id=excluded.instant_id"
+)
+SQL_UPSERT_TOKENS = (
+    "INSERT INTO users (chat_id, phone_number, access_token, refresh_token, token_expires_in, last_updated, "
+    "token_expires_at) VALUES (?,?,?,?,?,?,?) "
+    "ON CONFLICT(chat_id) DO UPDATE SET phone_number=excluded.phone_number, access_token=excluded.access_token, "
+    "refresh_token=excluded.refresh_token, token_expires_in=excluded.token_expires_in, "
+    "last_updated=excluded.last_updated, token_expires_at=excluded.token_expires_at"
+)
+
+# --- SCHEMA MIGRATIONS ---
+# Applied in order inside one transaction each; append new steps, never edit old ones.
+def _migrate_base_schema(conn):
+    # Everything before versioning. Databases from that era may be missing any
+    # of the later columns, so this step stays idempotent.
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS users (
             chat_id INTEGER PRIMARY KEY,
             phone_number TEXT,
             access_token TEXT,
             refresh_token TEXT,
             token_expires_in INTEGER,
-            last_updated TEXT,
-            device_uuid TEXT,
-            instant_id TEXT,
-            plan_type TEXT,
-            last_played_time TEXT
+            last_updated TEXT
         )
     ''')
-    cursor.execute("PRAGMA table_info(users)")
-    cols = [c[1] for c in cursor.fetchall()]
-    if 'device_uuid' not in cols:
-        cursor.execute("ALTER TABLE users ADD COLUMN device_uuid TEXT")
-    if 'instant_id' not in cols:
-        cursor.execute("ALTER TABLE users ADD COLUMN instant_id TEXT")
-    if 'plan_type' not in cols:
-        cursor.execute("ALTER TABLE users ADD COLUMN plan_type TEXT")
-    if 'last_played_time' not in cols:
-        cursor.execute("ALTER TABLE users ADD COLUMN last_played_time TEXT")
-    conn.commit()
-    conn.close()
+    cols = [c[1] for c in conn.execute("PRAGMA table_info(users)")]
+    for name in ('device_uuid', 'instant_id', 'plan_type', 'last_played_time'):
+        if name not in cols:
+            conn.execute(f"ALTER TABLE users ADD COLUMN {name} TEXT")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_last_played ON users(last_played_time)")
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS conversation_states (
+            chat_id INTEGER PRIMARY KEY,
+            state TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_states_expires ON conversation_states(expires_at)")
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sweep_progress (
+            name TEXT PRIMARY KEY,
+            last_chat_id INTEGER NOT NULL,
+            processed INTEGER NOT NULL,
+            failed INTEGER NOT NULL,
+            expired INTEGER NOT NULL,
+            updated_at TEXT
+        )
+    ''')
+
+def _migrate_token_expiry(conn):
+    # Absolute expiry (epoch seconds) so the refresher can range-scan instead of
+    # parsing last_updated + token_expires_in for every row.
+    conn.execute("ALTER TABLE users ADD COLUMN token_expires_at REAL")
+    rows = conn.execute(
+        "SELECT chat_id, last_updated, token_expires_in FROM users WHERE token_expires_in IS NOT NULL").fetchall()
+    conn.executemany("UPDATE users SET token_expires_at=? WHERE chat_id=?",
+                     [(token_expiry_ts(updated, expires_in), chat_id) for chat_id, updated, expires_in in rows])
+    conn.execute("CREATE INDEX idx_users_token_expires ON users(token_expires_at)")
+
+MIGRATIONS = (
+    _migrate_base_schema,
+    _migrate_token_expiry,
+)
+
+USER_CACHE_MB = float(os.environ.get("USER_CACHE_MB", "8"))
+
+class UserRecord:
+    __slots__ = ('chat_id',) + USER_COLUMNS
+
+    def __init__(self, chat_id, *values):
+        self.chat_id = chat_id
+        for name, value in zip(USER_COLUMNS, values):
+            setattr(self, name, value)
+
+    def nbytes(self):
+        return sys.getsizeof(self) + sum(sys.getsizeof(getattr(self, n)) for n in USER_COLUMNS)
+
+class UserCache:
+    """LRU of UserRecord bounded by an approximate memory budget."""
+
+    def __init__(self, max_mb=USER_CACHE_MB):
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, chat_id):
+        rec = self._data.get(chat_id)
+        if rec is None:
+            self.misses += 1
+            return None
+        self._data.move_to_end(chat_id)
+        self.hits += 1
+        return rec
+
+    def put(self, rec):
+        self.invalidate(rec.chat_id)
+        self._data[rec.chat_id] = rec
+        self.bytes += rec.nbytes()
+        self._evict()
+
+    def update(self, chat_id, **cols):
+        rec = self._data.get(chat_id)
+        if rec is None: return
+        before = rec.nbytes()
+        for name, value in cols.items(): setattr(rec, name, value)
+        self.bytes += rec.nbytes() - before
+        self._data.move_to_end(chat_id)
+        self._evict()
+
+    def invalidate(self, chat_id):
+        rec = self._data.pop(chat_id, None)
+        if rec is not None:
+            self.bytes -= rec.nbytes()
+
+    def _evict(self):
+        while self.bytes > self.max_bytes and self._data:
+            _, rec = self._data.popitem(last=False)
+            self.bytes -= rec.nbytes()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"entries": len(self._data), "bytes": self.bytes, "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0}
+
+user_cache = UserCache()
+
+class UserRepository:
+    """
+    One long-lived SQLite connection in WAL mode.
+    All queries run on a single worker thread so they never block the event loop
+    and the connection is never used from two threads at once.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+
+    def open(self):
+        folder = os.path.dirname(self.path)
+        if folder: os.makedirs(folder, exist_ok=True)
+        # cached_statements keeps the prepared statements for the SQL_* constants alive.
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=64)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA busy_timeout=5000")
+        self._init_schema()
+
+    def _init_schema(self):
+        # PRAGMA user_version records how many MIGRATIONS have been applied;
+        # a current database costs one pragma read at startup.
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        for target in range(version + 1, len(MIGRATIONS) + 1):
+            step = MIGRATIONS[target - 1]
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                step(self.conn)
+                self.conn.execute(f"PRAGMA user_version={target}")
+                self.conn.commit()
+            except BaseException:
+                self.conn.rollback()
+                raise
+            logger.info(f"Applied schema migration {target}: {step.__name__}")
+
+    async def run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._timed, fn, args)
+
+    @staticmethod
+    def _timed(fn, args):
+        with SQLITE_SECONDS.time(fn.__name__.lstrip("_")):
+            return fn(*args)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    # Blocking implementations, only ever called on the worker thread.
+    def _get_user(self, chat_id):
+        row = self.conn.execute(SQL_GET_USER, (chat_id,)).fetchone()
+        return UserRecord(chat_id, *row) if row else None
+
+    def _get_users(self, chat_ids, chunk=500):
+        # Returned in the order asked for; missing users are skipped.
+        found = {}
+        for i in range(0, len(chat_ids), chunk):
+            part = chat_ids[i:i + chunk]
+            for row in self.conn.execute(SQL_GET_USERS.format(",".join("?" * len(part))), part):
+                found[row[0]] = UserRecord(*row)
+        return [found[c] for c in chat_ids if c in found]
+
+    def _get_or_create_device(self, chat_id):
+        row = self.conn.execute(SQL_GET_DEVICE, (chat_id,)).fetchone()
+        instant_id = row[1] if row else None
+        if instant_id and len(instant_id) == 49:
+            return instant_id[:36], instant_id
+        instant_id = generate_synced_instant_id()
+        device_uuid = instant_id[:36]
+        with self.conn:
+            self.conn.execute(SQL_UPSERT_DEVICE, (chat_id, device_uuid, instant_id, dt_class.now().isoformat()))
+        return device_uuid, instant_id
+
+    def _execute(self, sql, params):
+        with self.conn:
+            self.conn.execute(sql, params)
+
+    def _apply_updates(self, batch):
+        # batch: {chat_id: {column: value}}, applied in a single transaction.
+        with self.conn:
+            self._write_updates(batch)
+
+    def _write_updates(self, batch):
+        for chat_id, cols in batch.items():
+            names = [c for c in cols if c in USER_COLUMNS]
+            if not names: continue
+            sql = f"UPDATE users SET {', '.join(n + '=?' for n in names)} WHERE chat_id=?"
+            self.conn.execute(sql, [cols[n] for n in names] + [chat_id])
+
+    async def get_user(self, chat_id):
+        return await self.run(self._get_user, chat_id)
+
+    async def get_or_create_device(self, chat_id):
+        return await self.run(self._get_or_create_device, chat_id)
+
+    def _recent_played(self, since_iso):
+        return self.conn.execute(SQL_RECENT_PLAYED, (since_iso,)).fetchall()
+
+    def _get_state(self, chat_id, now):
+        row = self.conn.execute(SQL_GET_STATE, (chat_id, now)).fetchone()
+        return row[0] if row else None
+
+    def _set_state(self, chat_id, state_json, expires_at, max_size):
+        with self.conn:
+            self.conn.execute(SQL_UPSERT_STATE, (chat_id, state_json, expires_at))
+            self.conn.execute(SQL_CAP_STATES, (max_size,))
+
+    def _purge_states(self, now, max_size):
+        with self.conn:
+            expired = self.conn.execute(SQL_PURGE_STATES, (now,)).rowcount
+            capped = self.conn.execute(SQL_CAP_STATES, (max_size,)).rowcount
+        return expired + capped
+
+    def _sweep_batch(self, after_chat_id, limit):
+        return self.conn.execute(SQL_SWEEP_BATCH, (after_chat_id, limit)).fetchall()
+
+    def _sweep_progress(self, name):
+        return self.conn.execute(SQL_SWEEP_GET, (name,)).fetchone()
+
+    def _commit_sweep_batch(self, updates, progress):
+        # Results and the resume cursor land in the same transaction.
+        with self.conn:
+            self._write_updates(updates)
+            self.conn.execute(SQL_SWEEP_SAVE, progress + (dt_class.now().isoformat(),))
+
+    def _token_expiries(self):
+        return self.conn.execute(SQL_TOKEN_EXPIRIES).fetchall()
+
+    async def execute(self, sql, params):
+        await self.run(self._execute, sql, params)
+
+    async def apply_updates(self, batch):
+        await self.run(self._apply_updates, batch)
+
+db = UserRepository(DBNAME)
+
+WRITE_BEHIND_INTERVAL = float(os.environ.get("WRITE_BEHIND_INTERVAL", "2"))
+
+class WriteBehindQueue:
+    """
+    Collects column updates per chat_id, merging repeated ones, and writes them
+    in one transaction every `interval` seconds and on shutdown.
+    """
+
+    def __init__(self, repo, interval=WRITE_BEHIND_INTERVAL):
+        self.repo = repo
+        self.interval = interval
+        self.pending = {}
+        self.flushing = {}
+        self._task = None
+
+    def put(self, chat_id, **cols):
+        self.pending.setdefault(chat_id, {}).update(cols)
+
+    def overlay(self, chat_id, record):
+        # Reads must see writes that have not been flushed yet, including the
+        # batch being written: a read queued ahead of it on the SQLite thread
+        # returns the pre-flush row.
+        if record is None: return record
+        for source in (self.flushing, self.pending):
+            cols = source.get(chat_id)
+            if cols:
+                for name, value in cols.items(): setattr(record, name, value)
+        return record
+
+    async def flush(self):
+        if not self.pending: return
+        batch, self.pending = self.pending, {}
+        self.flushing = batch
+        try:
+            await self.repo.apply_updates(batch)
+        except Exception as e:
+            logger.error(f"Write-behind flush failed ({len(batch)} users): {e}")
+            # Requeue, keeping any newer value written meanwhile.
+            for chat_id, cols in batch.items():
+                self.pending[chat_id] = {**cols, **self.pending.get(chat_id, {})}
+        finally:
+            if self.flushing is batch: self.flushing = {}
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+write_queue = WriteBehindQueue(db)
+
+def init_db():
+    db.open()
 
 def generate_synced_instant_id():
     u = uuid.uuid1()
@@ -68,105 +571,655 @@ def generate_synced_instant_id():
     ts_str = str(ts_ms).ljust(13, '0') 
     return f"{u}{ts_str}"
 
-def get_or_create_device_info(chat_id):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute('SELECT device_uuid, instant_id FROM users WHERE chat_id=?', (chat_id,))
-    row = c.fetchone()
-    
-    instant_id = None
-    if row: instant_id = row[1]
-    
-    updated = False
-    if not instant_id or len(instant_id) != 49:
-        instant_id = generate_synced_instant_id()
-        updated = True
-    
-    device_uuid = instant_id[:36]
-
-    if updated:
-        c.execute('SELECT chat_id FROM users WHERE chat_id=?', (chat_id,))
-        if c.fetchone():
-            c.execute('UPDATE users SET device_uuid=?, instant_id=? WHERE chat_id=?', (device_uuid, instant_id, chat_id))
-        else:
-            c.execute('INSERT INTO users (chat_id, device_uuid, instant_id, last_updated) VALUES (?,?,?,?)', 
-                      (chat_id, device_uuid, instant_id, dt_class.now().isoformat()))
-        conn.commit()
-        
-    conn.close()
+async def get_or_create_device_info(chat_id):
+    rec = user_cache.get(chat_id)
+    if rec is not None and rec.instant_id and len(rec.instant_id) == 49:
+        return rec.device_uuid, rec.instant_id
+    device_uuid, instant_id = await db.get_or_create_device(chat_id)
+    user_cache.update(chat_id, device_uuid=device_uuid, instant_id=instant_id)
     return device_uuid, instant_id
 
-def save_user_data(chat_id, phone, access, refresh, expires):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
+async def save_user_data(chat_id, phone, access, refresh, expires):
     now = dt_class.now().isoformat()
+    expires_at = time.time() + int(expires) if expires else None
+    await db.execute(SQL_UPSERT_TOKENS, (chat_id, phone, access, refresh, expires, now, expires_at))
+    user_cache.update(chat_id, phone_number=phone, access_token=access, refresh_token=refresh,
+                      token_expires_in=expires, last_updated=now, token_expires_at=expires_at)
+    if refresh and expires_at:
+        token_refresher.schedule(chat_id, expires_at, expires)
+
+async def update_user_plan(chat_id, plan):
+    write_queue.put(chat_id, plan_type=plan)
+    user_cache.update(chat_id, plan_type=plan)
+
+async def update_last_played(chat_id, played_time_str):
+    write_queue.put(chat_id, last_played_time=played_time_str)
+    user_cache.update(chat_id, last_played_time=played_time_str)
+    gift_scheduler.note_played(chat_id, played_time_str)
+
+async def get_user_data(chat_id):
+    rec = user_cache.get(chat_id)
+    if rec is None:
+        rec = write_queue.overlay(chat_id, await db.get_user(chat_id))
+        if rec is not None: user_cache.put(rec)
+    return rec
+
+# --- CONVERSATION STATE ---
+CONV_STATE_TTL = float(os.environ.get("CONV_STATE_TTL", "900"))
+CONV_STATE_MAX = int(os.environ.get("CONV_STATE_MAX", "10000"))
+
+class ConversationStore:
+    """
+    Pending login steps ("phone", {"st": "otp", "ph": ...}) per chat.
+    Stored in SQLite so they survive restarts and are visible to every instance
+    sharing the database; entries expire after `ttl` and the table is capped at `max_size`.
+    """
+
+    def __init__(self, repo, ttl=CONV_STATE_TTL, max_size=CONV_STATE_MAX):
+        self.repo = repo
+        self.ttl = ttl
+        self.max_size = max_size
+        self._task = None
+
+    async def get(self, chat_id):
+        raw = await self.repo.run(self.repo._get_state, chat_id, time.time())
+        return json.loads(raw) if raw else None
+
+    async def set(self, chat_id, state):
+        if state is None:
+            await self.repo.execute(SQL_DELETE_STATE, (chat_id,))
+        else:
+            await self.repo.run(self.repo._set_state, chat_id, json.dumps(state), time.time() + self.ttl, self.max_size)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(60)
+            try:
+                removed = await self.repo.run(self.repo._purge_states, time.time(), self.max_size)
+                if removed: logger.info(f"Purged {removed} conversation states")
+            except Exception as e:
+                logger.warning(f"Conversation state purge failed: {e}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+conv_states = ConversationStore(db)
+
+# --- TOKEN REFRESH ---
+TOKEN_REFRESH_MARGIN = float(os.environ.get("TOKEN_REFRESH_MARGIN", "300"))
+TOKEN_REFRESH_CONCURRENCY = int(os.environ.get("TOKEN_REFRESH_CONCURRENCY", "5"))
+TOKEN_REFRESH_MIN_DELAY = float(os.environ.get("TOKEN_REFRESH_MIN_DELAY", "30"))
+
+def token_expiry_ts(last_updated, expires_in):
     try:
-        c.execute('UPDATE users SET phone_number=?, access_token=?, refresh_token=?, token_expires_in=?, last_updated=? WHERE chat_id=?',
-                  (phone, access, refresh, expires, now, chat_id))
-        if c.rowcount == 0:
-            c.execute('INSERT INTO users (chat_id, phone_number, access_token, refresh_token, token_expires_in, last_updated) VALUES (?,?,?,?,?,?)',
-                      (chat_id, phone, access, refresh, expires, now))
-        conn.commit()
-    finally:
-        conn.close()
-
-def update_user_plan(chat_id, plan):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute('UPDATE users SET plan_type=? WHERE chat_id=?', (plan, chat_id))
-    conn.commit()
-    conn.close()
-
-def update_last_played(chat_id, played_time_str):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute('UPDATE users SET last_played_time=? WHERE chat_id=?', (played_time_str, chat_id))
-    conn.commit()
-    conn.close()
-
-def get_user_data(chat_id):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute('SELECT phone_number, access_token, refresh_token, token_expires_in, last_updated, device_uuid, instant_id, plan_type, last_played_time FROM users WHERE chat_id=?', (chat_id,))
-    row = c.fetchone()
-    conn.close()
-    if row:
-        return {
-            'phone_number': row[0], 'access_token': row[1], 'refresh_token': row[2], 
-            'token_expires_in': row[3], 'last_updated': row[4], 
-            'device_uuid': row[5], 'instant_id': row[6], 'plan_type': row[7], 'last_played_time': row[8]
-        }
-    return None
+        return dt_class.fromisoformat(last_updated).timestamp() + int(expires_in)
+    except (TypeError, ValueError):
+        return None
+
+class TokenRefresher:
+    """
+    Keeps a min-heap of (refresh_at, chat_id) and renews access tokens with the
+    stored refresh_token shortly before they expire. Also used on demand after a 401;
+    only scheduled refreshes queue on the concurrency limit, so a user waiting on
+    a refresh never sits behind the background backlog.
+    """
+
+    def __init__(self, margin=TOKEN_REFRESH_MARGIN, concurrency=TOKEN_REFRESH_CONCURRENCY,
+                 min_delay=TOKEN_REFRESH_MIN_DELAY):
+        self.margin = margin
+        self.min_delay = min_delay
+        self._heap = []
+        self._due = {}
+        self._inflight = {}
+        self._background = set()
+        self._sem = asyncio.Semaphore(concurrency)
+        self._wake = asyncio.Event()
+        self._task = None
+
+    def schedule(self, chat_id, expires_at, lifetime=None):
+        # Never lead by more than half the token's lifetime: with short-lived
+        # tokens (Keycloak defaults to 300 s) a fixed margin makes every fresh
+        # token due immediately and the refresher loops.
+        lead = self.margin if not lifetime else min(self.margin, int(lifetime) / 2)
+        due = max(expires_at - lead, time.time() + self.min_delay)
+        self._due[chat_id] = due
+        heapq.heappush(self._heap, (due, chat_id))
+        self._wake.set()
+
+    def unschedule(self, chat_id):
+        # Heap entries are dropped lazily when they surface.
+        self._due.pop(chat_id, None)
+
+    async def load(self):
+        rows = await db.run(db._token_expiries)
+        for chat_id, expires_at, lifetime in rows:
+            self.schedule(chat_id, expires_at, lifetime)
+        logger.info(f"Token refresher loaded {len(self._due)} users")
+
+    async def refresh_now(self, chat_id):
+        """Refreshes the user's token, sharing an in-flight refresh. Returns the new access token or None."""
+        task = self._inflight.get(chat_id)
+        if task is None:
+            task = asyncio.create_task(self._refresh(chat_id))
+            self._inflight[chat_id] = task
+            task.add_done_callback(lambda _: self._inflight.pop(chat_id, None))
+        # Shielded so a caller timing out does not cancel a refresh other callers share.
+        return await asyncio.shield(task)
+
+    async def _refresh_scheduled(self, chat_id):
+        async with self._sem:
+            await self.refresh_now(chat_id)
+
+    async def _refresh(self, chat_id):
+        u = await get_user_data(chat_id)
+        if not u or not u.refresh_token:
+            self.unschedule(chat_id)
+            return None
+        res = await refresh_access_token(u.phone_number, u.refresh_token, u.device_uuid)
+        if res["ok"]:
+            await save_user_data(chat_id, u.phone_number, res["access"], res["refresh"], res["expires"])
+            logger.info(f"Refreshed token for {chat_id}")
+            return res["access"]
+        logger.warning(f"Token refresh for {chat_id} failed: {res.get('err')}")
+        if res.get("invalid"):
+            # Refresh token is dead; clear the session so /start asks for login again.
+            self.unschedule(chat_id)
+            await save_user_data(chat_id, u.phone_number, None, None, None)
+        else:
+            self.schedule(chat_id, time.time() + self.margin + 60)
+        return None
+
+    async def _run(self):
+        while True:
+            now = time.time()
+            while self._heap:
+                due, chat_id = self._heap[0]
+                if self._due.get(chat_id) != due:
+                    heapq.heappop(self._heap)
+                elif due <= now:
+                    heapq.heappop(self._heap)
+                    del self._due[chat_id]
+                    task = asyncio.create_task(self._refresh_scheduled(chat_id))
+                    self._background.add(task)
+                    task.add_done_callback(self._background.discard)
+                else:
+                    break
+            self._wake.clear()
+            timeout = self._heap[0][0] - now if self._heap else None
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # Refreshes still running would otherwise hit the closed HTTP client and SQLite executor.
+        tasks = [t for t in (self._task,) if t is not None] + list(self._background) + list(self._inflight.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
+
+token_refresher = TokenRefresher()
+
+# --- GIFT SCHEDULER ---
+GIFT_COOLDOWN = 24 * 3600
+GIFT_NOTIFY = os.environ.get("GIFT_NOTIFY", "1") == "1"
+GIFT_NOTIFY_RATE = float(os.environ.get("GIFT_NOTIFY_RATE", "10"))
+GIFT_NOTIFY_JITTER = float(os.environ.get("GIFT_NOTIFY_JITTER", "120"))
+
+def parse_played_time(played_time_str):
+    """Returns the epoch time the next gift becomes available, or None."""
+    ts = parse_iso_ts(played_time_str)
+    return ts + GIFT_COOLDOWN if ts is not None else None
+
+def format_cooldown(rem_seconds):
+    hrs, sec = divmod(int(rem_seconds), 3600)
+    mins, _ = divmod(sec, 60)
+    return f"⏱️ **الهدية:** باقي {hrs} ساعة و {mins} دقيقة"
+
+class GiftScheduler:
+    """
+    Tracks when each user's gift cooldown ends (a heap of ready times) and
+    sends a "gift available" message when it does. Sends are jittered and
+    rate-limited so cooldowns that end together do not burst.
+    """
+
+    def __init__(self, rate=GIFT_NOTIFY_RATE, jitter=GIFT_NOTIFY_JITTER):
+        self.rate = rate
+        self.jitter = jitter
+        self._ready = {}
+        self._heap = []
+        self._wake = asyncio.Event()
+        self._outbox = asyncio.Queue()
+        self._tasks = []
+        self.bot = None
+
+    def ready_at(self, chat_id):
+        return self._ready.get(chat_id)
+
+    def note_played(self, chat_id, played_time_str):
+        return self.note_ready(chat_id, parse_played_time(played_time_str))
+
+    def note_ready(self, chat_id, ready):
+        if ready is None or self._ready.get(chat_id) == ready:
+            return ready
+        self._ready[chat_id] = ready
+        # Only the timer drains the heap; with notifications off, _ready alone serves as the cooldown cache.
+        if self._tasks and ready > time.time():
+            heapq.heappush(self._heap, (ready + random.uniform(0, self.jitter), ready, chat_id))
+            self._wake.set()
+        return ready
+
+    async def load(self):
+        since = (dt_class.now() - datetime.timedelta(seconds=GIFT_COOLDOWN)).strftime("%Y-%m-%dT%H:%M:%S")
+        rows = await db.run(db._recent_played, since)
+        for chat_id, played in rows:
+            self.note_played(chat_id, played)
+        logger.info(f"Gift scheduler loaded {len(self._heap)} pending cooldowns")
+
+    async def _run_timer(self):
+        while True:
+            now = time.time()
+            while self._heap and self._heap[0][0] <= now:
+                _, ready, chat_id = heapq.heappop(self._heap)
+                # Skip entries superseded by a newer play.
+                if self._ready.get(chat_id) == ready:
+                    del self._ready[chat_id]
+                    self._outbox.put_nowait(chat_id)
+            self._wake.clear()
+            timeout = self._heap[0][0] - now if self._heap else None
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _run_sender(self):
+        markup = InlineKeyboardMarkup([[InlineKeyboardButton("🎁 أحصل على الهدية الآن", callback_data="claim_gift")]])
+        while True:
+            chat_id = await self._outbox.get()
+            try:
+                await self.bot.send_message(chat_id, "🎉 **الهدية متوفرة الآن!**", reply_markup=markup, parse_mode='Markdown')
+            except Exception as e:
+                logger.warning(f"Gift notification to {chat_id} failed: {e}")
+            await asyncio.sleep(1 / self.rate)
+
+    def start(self, bot):
+        self.bot = bot
+        if not self._tasks:
+            now = time.time()
+            self._heap = [(r + random.uniform(0, self.jitter), r, c) for c, r in self._ready.items() if r > now]
+            heapq.heapify(self._heap)
+            self._tasks = [asyncio.create_task(self._run_timer()), asyncio.create_task(self._run_sender())]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+gift_scheduler = GiftScheduler()
 
 # --- CORE LOGIC ---
+@lru_cache(maxsize=4096)
+def normalize_msisdn(phone):
+    return "213" + phone[1:] if phone.startswith("05") else phone
+
+@lru_cache(maxsize=4096)
+def _fingerprint_suffix(instance_id, phone):
+    return (instance_id + phone).encode('utf-8')
+
 def generate_device_fingerprint(instance_id, phone, ts_str):
     key = ts_str.encode('utf-8')
-    msg = (ts_str + instance_id + phone).encode('utf-8')
+    msg = key + _fingerprint_suffix(instance_id, phone)
     return hmac.new(key, msg, hashlib.sha256).hexdigest()
 
+class RequestSigner:
+    """
+    Stamps signed requests with the upstream's clock. The offset is estimated from
+    the Date header of each response (1 s resolution, so samples are smoothed).
+    """
+
+    def __init__(self, alpha=0.2):
+        self.alpha = alpha
+        self.offset_ms = 0.0
+        self.samples = 0
+
+    def observe(self, date_header, sent_at, received_at):
+        if not date_header: return
+        try:
+            server_ms = parsedate_to_datetime(date_header).timestamp() * 1000
+        except (TypeError, ValueError):
+            return
+        # Date is truncated to the second: assume the middle of that second and of the round trip.
+        sample = server_ms + 500 - (sent_at + received_at) * 500
+        if abs(sample) > 86400000: return
+        if self.samples == 0:
+            self.offset_ms = sample
+        else:
+            self.offset_ms += self.alpha * (sample - self.offset_ms)
+        self.samples += 1
+
+    def now_ms(self):
+        return int(time.time() * 1000 + self.offset_ms)
+
+    def sign(self, instance_id, msisdn):
+        ts_now = str(self.now_ms())
+        return ts_now, generate_device_fingerprint(instance_id, msisdn, ts_now)
+
+signer = RequestSigner()
+
 # --- API HELPERS ---
-URL_OTP = "https://apis.ooredoo.dz/api/auth/realms/myooredoo/protocol/openid-connect/token"
-URL_CHECKPOINT = "https://apis.ooredoo.dz/api/ooredoo-bff/checkpoint/token"
-URL_SNAP = "https://apis.ooredoo.dz/api/ooredoo-bff/snap-chat/eligibility"
-URL_GIFT_STATUS = "https://apis.ooredoo.dz/api/ooredoo-bff/gamification/status"
-URL_GIFT_PLAY = "https://apis.ooredoo.dz/api/ooredoo-bff/gamification/play"
-URL_PACKAGES = "https://apis.ooredoo.dz/api/ooredoo-bff/bundle/getActivePackages"
-URL_VALIDATE = "https://apis.ooredoo.dz/api/ooredoo-bff/users/validateUser"
+# Overridable so the bot can be pointed at a local stand-in (see bench.py).
+API_BASE = os.environ.get("OOREDOO_API_BASE", "https://apis.ooredoo.dz").rstrip("/")
+URL_OTP = f"{API_BASE}/api/auth/realms/myooredoo/protocol/openid-connect/token"
+URL_CHECKPOINT = f"{API_BASE}/api/ooredoo-bff/checkpoint/token"
+URL_SNAP = f"{API_BASE}/api/ooredoo-bff/snap-chat/eligibility"
+URL_GIFT_STATUS = f"{API_BASE}/api/ooredoo-bff/gamification/status"
+URL_GIFT_PLAY = f"{API_BASE}/api/ooredoo-bff/gamification/play"
+URL_PACKAGES = f"{API_BASE}/api/ooredoo-bff/bundle/getActivePackages"
+URL_VALIDATE = f"{API_BASE}/api/ooredoo-bff/users/validateUser"
+
+# --- HTTP CLIENT ---
+BASE_HEADERS = {
+    "X-platform-origin": "mobile-android",
+    "User-Agent": "Dart/3.4 (dart:io)",
+}
+FORM_CONTENT_TYPE = "application/x-www-form-urlencoded; charset=utf-8"
+
+# Endpoint label for metrics, logs and breakers (two URLs end in /token).
+ENDPOINT_NAMES = {
+    URL_CHECKPOINT: "checkpoint",
+    URL_OTP: "oidc_token",
+    URL_SNAP: "eligibility",
+    URL_GIFT_STATUS: "gift_status",
+    URL_GIFT_PLAY: "gift_play",
+    URL_PACKAGES: "packages",
+    URL_VALIDATE: "validate_user",
+}
+
+# Read timeouts per endpoint (seconds). Token and play calls are the slow ones upstream.
+ENDPOINT_TIMEOUTS = {
+    URL_CHECKPOINT: 8.0,
+    URL_OTP: 15.0,
+    URL_SNAP: 10.0,
+    URL_GIFT_STATUS: 10.0,
+    URL_GIFT_PLAY: 20.0,
+    URL_PACKAGES: 12.0,
+    URL_VALIDATE: 10.0,
+}
+DEFAULT_TIMEOUT = 10.0
+CONNECT_TIMEOUT = 5.0
+
+UPSTREAM_RATE = float(os.environ.get("UPSTREAM_RATE", "20"))
+UPSTREAM_BURST = float(os.environ.get("UPSTREAM_BURST", "40"))
+BREAKER_FAILURES = int(os.environ.get("BREAKER_FAILURES", "5"))
+BREAKER_RESET = float(os.environ.get("BREAKER_RESET", "30"))
+GET_RETRIES = int(os.environ.get("GET_RETRIES", "2"))
+RETRY_BACKOFF = 0.2
+
+class UpstreamError(Exception):
+    """Raised when an upstream call returns an unusable response."""
+
+    def __init__(self, msg="", status=None):
+        super().__init__(msg)
+        self.status = status
+
+class TokenExpired(UpstreamError):
+    """Raised when an upstream call is rejected with 401."""
+
+class CircuitOpen(UpstreamError):
+    """Raised instead of calling an endpoint whose circuit is open."""
+
+class TokenBucket:
+    def __init__(self, rate=UPSTREAM_RATE, burst=UPSTREAM_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class CircuitBreaker:
+    """
+    Opens after `failures` consecutive errors and fails fast for `reset` seconds,
+    then lets a single probe through (half-open) before closing again.
+    """
+
+    def __init__(self, name, failures=BREAKER_FAILURES, reset=BREAKER_RESET):
+        self.name = name
+        self.failures = failures
+        self.reset = reset
+        self.errors = 0
+        self.opened_at = None
+        self.probing = False
+
+    @property
+    def state(self):
+        if self.opened_at is None: return "closed"
+        if time.monotonic() - self.opened_at >= self.reset: return "half-open"
+        return "open"
+
+    def check(self):
+        state = self.state
+        if state == "open" or (state == "half-open" and self.probing):
+            UPSTREAM_RESPONSES.inc(self.name, "circuit_open")
+            raise CircuitOpen(f"circuit open for {self.name}")
+        if state == "half-open":
+            self.probing = True
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info(f"Circuit closed for {self.name}")
+        self.errors = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self):
+        self.errors += 1
+        self.probing = False
+        if self.opened_at is not None or self.errors >= self.failures:
+            if self.opened_at is None:
+                logger.warning(f"Circuit opened for {self.name} after {self.errors} failures")
+            self.opened_at = time.monotonic()
+
+class OoredooClient:
+    """Shared async client for apis.ooredoo.dz with a keep-alive connection pool."""
+
+    def __init__(self, max_connections=int(os.environ.get("HTTP_MAX_CONNECTIONS", "50")),
+                 max_keepalive=int(os.environ.get("HTTP_MAX_KEEPALIVE", "20"))):
+        self._limits = httpx.Limits(max_connections=max_connections,
+                                    max_keepalive_connections=max_keepalive,
+                                    keepalive_expiry=60.0)
+        self._client = None
+        self.buckets = {}
+        self.breakers = {}
+
+    @property
+    def client(self):
+        # Created lazily so it binds to the running event loop.
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(limits=self._limits, headers=BASE_HEADERS,
+                                             timeout=httpx.Timeout(DEFAULT_TIMEOUT, connect=CONNECT_TIMEOUT))
+        return self._client
+
+    @staticmethod
+    def headers(extra=None, form=False):
+        h = dict(BASE_HEADERS)
+        if form: h["Content-Type"] = FORM_CONTENT_TYPE
+        if extra: h.update(extra)
+        return h
+
+    def _guards(self, url):
+        if url not in self.breakers:
+            self.buckets[url] = TokenBucket()
+            self.breakers[url] = CircuitBreaker(ENDPOINT_NAMES.get(url, url.rsplit("/", 1)[-1]))
+        return self.buckets[url], self.breakers[url]
+
+    async def request(self, method, url, headers=None, params=None, data=None):
+        timeout = httpx.Timeout(ENDPOINT_TIMEOUTS.get(url, DEFAULT_TIMEOUT), connect=CONNECT_TIMEOUT)
+        bucket, breaker = self._guards(url)
+        # Only idempotent GETs are retried.
+        attempts = 1 + (GET_RETRIES if method == "GET" else 0)
+        for attempt in range(attempts):
+            breaker.check()
+            sent_at = time.time()
+            try:
+                await bucket.acquire()
+                sent_at = time.time()
+                r = await self.client.request(method, url, headers=headers, params=params, data=data, timeout=timeout)
+                signer.observe(r.headers.get("Date"), sent_at, time.time())
+            except httpx.TransportError as e:
+                UPSTREAM_SECONDS.observe(time.time() - sent_at, breaker.name)
+                UPSTREAM_RESPONSES.inc(breaker.name, type(e).__name__)
+                breaker.record_failure()
+                if attempt + 1 == attempts: raise
+            except BaseException:
+                # Cancelled (e.g. a dashboard section timing out) or failed unexpectedly:
+                # free the half-open probe slot or the breaker never closes again.
+                breaker.probing = False
+                raise
+            else:
+                UPSTREAM_SECONDS.observe(time.time() - sent_at, breaker.name)
+                UPSTREAM_RESPONSES.inc(breaker.name, str(r.status_code))
+                if r.status_code < 500:
+                    breaker.record_success()
+                    return r
+                breaker.record_failure()
+                if attempt + 1 == attempts: return r
+            # Full jitter exponential backoff.
+            await asyncio.sleep(random.uniform(0, RETRY_BACKOFF * 2 ** attempt))
+
+    async def get(self, url, **kw):
+        return await self.request("GET", url, **kw)
+
+    async def post(self, url, **kw):
+        return await self.request("POST", url, **kw)
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+api = OoredooClient()
+
+# --- RESPONSE MODELS ---
+BUNDLE_ICONS = {"DATA": "🌐", "YOUTUBE": "📺", "VOICE": "📞", "SMS": "✉️"}
+SEPARATOR = "─" * 20
+_BALANCE_HEAD = ("💰 **الرصيد:** `{} DA`\n" + SEPARATOR + "\n").format
+_BUNDLE_LINE = "{} **{}:** {} {} {}\n".format
+_DASHBOARD = ("📱 **الخطة:** {}\n{}\n" + SEPARATOR + "\n{}").format
+NO_BUNDLES = "🚫 لا توجد اشتراكات.\n"
+
+def decode(r):
+    """Decodes a response body once, with orjson when available."""
+    return json_loads(r.content)
+
+@lru_cache(maxsize=8192)
+def parse_iso_ts(value):
+    """Epoch seconds for an upstream timestamp like 2026-02-14T13:21:48.563 (local time; fraction dropped)."""
+    try:
+        return dt_class.fromisoformat(value[:19]).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+class TokenGrant:
+    __slots__ = ('access', 'refresh', 'expires')
+
+    def __init__(self, access, refresh, expires):
+        self.access, self.refresh, self.expires = access, refresh, expires
+
+    @classmethod
+    def from_json(cls, d, refresh_fallback=None):
+        return cls(d.get("access_token"), d.get("refresh_token", refresh_fallback), d.get("expires_in", 3600))
+
+class Bundle:
+    __slots__ = ('name', 'remaining', 'unit', 'expires_at')
+
+    def __init__(self, name, remaining, unit, expires_at):
+        self.name, self.remaining, self.unit, self.expires_at = name, remaining, unit, expires_at
+
+    @classmethod
+    def from_json(cls, d):
+        exp = d.get("expireDate")
+        return cls(d.get("allocationName", "Unknown"), d.get("remainingBalance", "0"), d.get("unit") or "",
+                   parse_iso_ts(exp) if exp else None)
+
+class Balance:
+    __slots__ = ('amount', 'bundles')
+
+    def __init__(self, amount, bundles):
+        self.amount, self.bundles = amount, bundles
+
+    @classmethod
+    def from_json(cls, d):
+        m = d.get("monthlyDataSmartBundlePurchases") or {}
+        sources = (d.get("activeBundles"), m.get("dataBundles"), m.get("smartBundles"))
+        return cls(d.get("accountBalance", "0"), tuple(Bundle.from_json(b) for src in sources if src for b in src))
+
+class GiftStatus:
+    __slots__ = ('played', 'last_played')
+
+    def __init__(self, played, last_played):
+        self.played, self.last_played = played, last_played
+
+    @classmethod
+    def from_json(cls, d):
+        return cls(bool(d.get("played", False)), d.get("lastPlayedTime"))
+
+class PlayResult:
+    __slots__ = ('gift_name', 'validity', 'played_time')
+
+    def __init__(self, gift_name, validity, played_time):
+        self.gift_name, self.validity, self.played_time = gift_name, validity, played_time
+
+    @classmethod
+    def from_json(cls, d):
+        return cls(d.get("giftName", "هدية"), d.get("validityHour", "?"), d.get("playedTime"))
+
+def render_balance(bal, now=None):
+    now = now or time.time()
+    parts = [_BALANCE_HEAD(bal.amount)]
+    if not bal.bundles:
+        parts.append(NO_BUNDLES)
+    for b in bal.bundles:
+        days = ""
+        if b.expires_at is not None:
+            d = int((b.expires_at - now) // 86400)
+            days = f"({d} يوم)" if d >= 0 else "(منتهي)"
+        parts.append(_BUNDLE_LINE(BUNDLE_ICONS.get(b.name, "📦"), b.name, b.remaining, b.unit, days))
+    return "".join(parts)
 
 # --- LOGIN HANDLERS ---
 
-async def request_checkpoint(phone, device_uuid):
-    headers = {
+async def request_checkpoint(phone, device_uuid=None):
+    extra = {
         "X-msisdn": phone,
-        "X-platform-origin": "mobile-android",
         "X-path": "/api/auth/realms/myooredoo/protocol/openid-connect/token",
         "X-method": "POST",
-        "X-Device-ID": device_uuid, 
-        "User-Agent": "Dart/3.4 (dart:io)",
-        "Content-Type": "application/x-www-form-urlencoded; charset=utf-8"
     }
+    if device_uuid: extra["X-Device-ID"] = device_uuid
+    headers = api.headers(extra, form=True)
     try:
-        r = requests.post(URL_CHECKPOINT, headers=headers)
+        r = await api.post(URL_CHECKPOINT, headers=headers)
         if r.status_code == 202:
             return {"nonce": r.headers.get("X-Nonce-Id"), "chronos": r.headers.get("X-Chronos-Id"), "ok": True}
         return {"ok": False, "err": f"Checkpoint Failed: {r.status_code}"}
@@ -174,71 +1227,121 @@ async def request_checkpoint(phone, device_uuid):
         return {"ok": False, "err": str(e)}
 
 async def send_otp_request(phone, nonce, chronos, device_uuid):
-    headers = {
+    headers = api.headers({
         "X-Nonce-Id": nonce,
         "X-Chronos-Id": chronos,
-        "X-platform-origin": "mobile-android",
         "X-Device-ID": device_uuid,
-        "User-Agent": "Dart/3.4 (dart:io)",
-        "Content-Type": "application/x-www-form-urlencoded; charset=utf-8"
-    }
+    }, form=True)
     data = {"client_id": "myooredoo-app", "grant_type": "password", "username": phone}
     try:
-        r = requests.post(URL_OTP, headers=headers, data=data)
+        r = await api.post(URL_OTP, headers=headers, data=data)
         if r.status_code == 403: return {"ok": True}
         return {"ok": False, "err": f"Send OTP Failed: {r.status_code}\n{r.text}"}
     except Exception as e:
         return {"ok": False, "err": str(e)}
 
 async def verify_otp_request(phone, otp, nonce, chronos, device_uuid):
-    headers = {
+    headers = api.headers({
         "X-Nonce-Id": nonce,
         "X-Chronos-Id": chronos,
-        "X-platform-origin": "mobile-android",
         "X-Device-ID": device_uuid,
-        "User-Agent": "Dart/3.4 (dart:io)",
-        "Content-Type": "application/x-www-form-urlencoded; charset=utf-8"
-    }
+    }, form=True)
     data = {"client_id": "myooredoo-app", "grant_type": "password", "username": phone, "otp": otp}
     try:
-        r = requests.post(URL_OTP, headers=headers, data=data)
+        r = await api.post(URL_OTP, headers=headers, data=data)
         if r.status_code == 200:
-            return {"ok": True, "access": r.json().get("access_token"), "refresh": r.json().get("refresh_token")}
+            grant = TokenGrant.from_json(decode(r))
+            return {"ok": True, "access": grant.access, "refresh": grant.refresh, "expires": grant.expires}
         return {"ok": False, "err": f"Verify Failed: {r.status_code}\n{r.text}"}
     except Exception as e:
         return {"ok": False, "err": str(e)}
 
+async def refresh_access_token(phone, refresh_token, device_uuid):
+    sec = await request_checkpoint(phone, device_uuid)
+    if not sec["ok"]:
+        return sec
+    headers = api.headers({
+        "X-Nonce-Id": sec["nonce"],
+        "X-Chronos-Id": sec["chronos"],
+        "X-Device-ID": device_uuid,
+    }, form=True)
+    data = {"client_id": "myooredoo-app", "grant_type": "refresh_token", "refresh_token": refresh_token}
+    try:
+        r = await api.post(URL_OTP, headers=headers, data=data)
+        if r.status_code == 200:
+            grant = TokenGrant.from_json(decode(r), refresh_fallback=refresh_token)
+            return {"ok": True, "access": grant.access, "refresh": grant.refresh, "expires": grant.expires}
+        # 400/401 means the refresh token itself is no longer valid.
+        return {"ok": False, "invalid": r.status_code in (400, 401), "err": f"Refresh Failed: {r.status_code}"}
+    except Exception as e:
+        return {"ok": False, "err": str(e)}
+
+# --- CHECKPOINT PREFETCH ---
+CHECKPOINT_TTL = float(os.environ.get("CHECKPOINT_TTL", "30"))
+
+class CheckpointPrefetcher:
+    """
+    Fetches checkpoint nonces ahead of the request that needs them.
+    A prefetched nonce is handed out at most once and dropped after `ttl` seconds.
+    """
+
+    def __init__(self, ttl=CHECKPOINT_TTL):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._slots = {}
+
+    def _fresh(self, slot):
+        return slot is not None and time.monotonic() - slot[0] < self.ttl
+
+    def prefetch(self, phone, device_uuid=None):
+        key = (phone, device_uuid)
+        if self._fresh(self._slots.get(key)):
+            return
+        self._purge()
+        self._slots[key] = (time.monotonic(), asyncio.create_task(request_checkpoint(phone, device_uuid)))
+
+    def ready(self, phone, device_uuid=None):
+        slot = self._slots.get((phone, device_uuid))
+        return self._fresh(slot) and slot[1].done() and slot[1].result()["ok"]
+
+    async def take(self, phone, device_uuid=None):
+        slot = self._slots.pop((phone, device_uuid), None)
+        if self._fresh(slot):
+            sec = await slot[1]
+            if sec["ok"]:
+                self.hits += 1
+                return sec
+        self.misses += 1
+        return await request_checkpoint(phone, device_uuid)
+
+    def _purge(self):
+        for key in [k for k, slot in self._slots.items() if not self._fresh(slot)]:
+            self._slots.pop(key)[1].cancel()
+
+checkpoints = CheckpointPrefetcher()
+
 # --- DATA FETCHING FUNCTIONS ---
 
 def get_headers_verified(access_token, phone, instant_id):
-    clean_phone = phone
-    if clean_phone.startswith("05"): clean_phone = "213" + clean_phone[1:]
-    
-    time.sleep(0.1) # Sync delay
-    ts_now = str(int(time.time() * 1000))
-    fp = generate_device_fingerprint(instant_id, clean_phone, ts_now)
+    clean_phone = normalize_msisdn(phone)
+    ts_now, fp = signer.sign(instant_id, clean_phone)
     
-    return {
+    return api.headers({
         "X-Device-Fingerprint": fp,
-        "X-Platform-Origin": "mobile-android",
         "Authorization": f"Bearer {access_token}",
         "X-Timestamp": ts_now,
         "X-Instance-Id": instant_id,
         "X-Msisdn": clean_phone
-    }
+    })
 
 async def fetch_user_plan(access_token, phone, instant_id):
-    clean_phone = phone
-    if clean_phone.startswith("05"): clean_phone = "213" + clean_phone[1:]
+    clean_phone = normalize_msisdn(phone)
     headers = get_headers_verified(access_token, phone, instant_id)
-    url = f"{URL_VALIDATE}?msisdn={clean_phone}"
-    try:
-        r = requests.get(url, headers=headers)
-        if r.status_code == 200:
-            return r.json().get("planType", "Unknown")
-        return "Unknown"
-    except:
-        return "Error"
+    r = await api.get(URL_VALIDATE, headers=headers, params={"msisdn": clean_phone})
+    if r.status_code == 401: raise TokenExpired()
+    if r.status_code != 200: raise UpstreamError(f"validateUser returned {r.status_code}", r.status_code)
+    return decode(r).get("planType", "Unknown")
 
 async def fetch_gift_info(chat_id, access_token, phone, instant_id, cached_last_played):
     """
@@ -247,217 +1350,325 @@ async def fetch_gift_info(chat_id, access_token, phone, instant_id, cached_last_
     2. If cache empty or expired, calls API.
     """
     
-    # 1. CACHE CHECK
-    if cached_last_played:
-        try:
-            # Parse stored time (e.g., 2026-02-14T13:21:48.563...)
-            clean_ts = cached_last_played.split(".")[0]
-            last_dt = dt_class.strptime(clean_ts, "%Y-%m-%dT%H:%M:%S")
-            next_gift_dt = last_dt + datetime.timedelta(hours=24)
-            rem = next_gift_dt - dt_class.now()
-            
-            if rem.total_seconds() > 0:
-                # Still in cooldown, rely on cache
-                hrs, sec = divmod(rem.seconds, 3600)
-                mins, _ = divmod(sec, 60)
-                return f"⏱️ **الهدية:** باقي {hrs} ساعة و {mins} دقيقة", False
-        except Exception as e:
-            # Cache invalid, proceed to API
-            pass
+    # 1. CACHE CHECK (timestamp is parsed once per update by the gift scheduler)
+    ready_at = gift_scheduler.ready_at(chat_id)
+    if ready_at is None and cached_last_played:
+        ready_at = gift_scheduler.note_played(chat_id, cached_last_played)
+    if ready_at is not None and ready_at > time.time():
+        # Still in cooldown, rely on cache
+        return format_cooldown(ready_at - time.time()), False
 
     # 2. API CHECK
-    headers = get_headers_verified(access_token, phone, instant_id)
     try:
-        r = requests.get(URL_GIFT_STATUS, headers=headers)
-        if r.status_code == 200:
-            data = r.json()
-            played = data.get("played", False)
-            last_played_str = data.get("lastPlayedTime")
-            
-            if played and last_played_str:
-                # Update DB for next time
-                update_last_played(chat_id, last_played_str)
-                
-                # Calc time
-                try:
-                    clean_ts = last_played_str.split(".")[0]
-                    last_dt = dt_class.strptime(clean_ts, "%Y-%m-%dT%H:%M:%S")
-                    next_dt = last_dt + datetime.timedelta(hours=24)
-                    rem = next_dt - dt_class.now()
-                    
-                    if rem.total_seconds() > 0:
-                        hrs, sec = divmod(rem.seconds, 3600)
-                        mins, _ = divmod(sec, 60)
-                        return f"⏱️ **الهدية:** باقي {hrs} ساعة و {mins} دقيقة", False
-                    else:
-                        return "🎉 **الهدية متوفرة!**", True
-                except:
-                    return "⚠️ خطأ في وقت الهدية", False
-            else:
-                return "🎉 **الهدية متوفرة!**", True
-        else:
-            return f"❌ خطأ هدية ({r.status_code})", False
+        status = await fetch_gift_status(access_token, phone, instant_id)
+    except TokenExpired:
+        raise
+    except UpstreamError as e:
+        if e.status is None: return "❌ خطأ شبكة", False
+        return f"❌ خطأ هدية ({e.status})", False
     except Exception as e:
         return f"❌ خطأ شبكة", False
 
+    if status.played and status.last_played:
+        # Update DB for next time
+        await update_last_played(chat_id, status.last_played)
+        
+        # Calc time
+        ready_at = gift_scheduler.ready_at(chat_id)
+        if ready_at is None:
+            return "⚠️ خطأ في وقت الهدية", False
+        if ready_at > time.time():
+            return format_cooldown(ready_at - time.time()), False
+    return "🎉 **الهدية متوفرة!**", True
+
+async def fetch_gift_status(access_token, phone, instant_id):
+    headers = get_headers_verified(access_token, phone, instant_id)
+    r = await api.get(URL_GIFT_STATUS, headers=headers)
+    if r.status_code == 401: raise TokenExpired()
+    if r.status_code != 200: raise UpstreamError(f"gamification/status returned {r.status_code}", r.status_code)
+    return GiftStatus.from_json(decode(r))
+
 async def fetch_balance_bundles(access_token, phone, instant_id):
-    clean_phone = phone
-    if clean_phone.startswith("05"): clean_phone = "213" + clean_phone[1:]
+    clean_phone = normalize_msisdn(phone)
     headers = get_headers_verified(access_token, phone, instant_id)
-    url = f"{URL_PACKAGES}?msisdn={clean_phone}"
-    try:
-        r = requests.get(url, headers=headers)
-        if r.status_code == 200:
-            data = r.json()
-            balance = data.get("accountBalance", "0")
-            msg = f"💰 **الرصيد:** `{balance} DA`\n"
-            msg += "─" * 20 + "\n"
-            
-            all_bundles = []
-            if "activeBundles" in data: all_bundles.extend(data["activeBundles"])
-            if "monthlyDataSmartBundlePurchases" in data:
-                m = data["monthlyDataSmartBundlePurchases"]
-                if "dataBundles" in m: all_bundles.extend(m["dataBundles"])
-                if "smartBundles" in m: all_bundles.extend(m["smartBundles"])
-            
-            if not all_bundles:
-                msg += "🚫 لا توجد اشتراكات.\n"
-            else:
-                for b in all_bundles:
-                    name = b.get("allocationName", "Unknown")
-                    rem = b.get("remainingBalance", "0")
-                    unit = b.get("unit") or ""
-                    
-                    if name == "DATA": icon = "🌐"
-                    elif name == "YOUTUBE": icon = "📺"
-                    elif name == "VOICE": icon = "📞"
-                    elif name == "SMS": icon = "✉️"
-                    else: icon = "📦"
-                    
-                    days = ""
-                    if b.get("expireDate"):
-                        try:
-                            exp = dt_class.strptime(b.get("expireDate").split(".")[0], "%Y-%m-%dT%H:%M:%S")
-                            d = (exp - dt_class.now()).days
-                            days = f"({d} يوم)" if d >= 0 else "(منتهي)"
-                        except: pass
-                    
-                    msg += f"{icon} **{name}:** {rem} {unit} {days}\n"
-            return msg
-        else:
-            return "⚠️ فشل جلب الرصيد"
-    except:
-        return "⚠️ خطأ في الرصيد"
+    r = await api.get(URL_PACKAGES, headers=headers, params={"msisdn": clean_phone})
+    if r.status_code == 401: raise TokenExpired()
+    if r.status_code != 200: raise UpstreamError(f"getActivePackages returned {r.status_code}", r.status_code)
+    return Balance.from_json(decode(r))
 
 # --- MAIN DASHBOARD ---
+SECTION_TIMEOUT = float(os.environ.get("DASH_SECTION_TIMEOUT", "12"))
+DASH_CACHE_TTL = float(os.environ.get("DASH_CACHE_TTL", "30"))
+DASH_CACHE_MAX_CHATS = int(os.environ.get("DASH_CACHE_MAX_CHATS", "5000"))
+DASH_STALE_TTL = float(os.environ.get("DASH_STALE_TTL", "600"))
+# Progressive rendering: skeleton after this many seconds, then at most one
+# edit per interval (Telegram throttles rapid edits of the same message).
+DASH_STREAM = os.environ.get("DASH_STREAM", "1") == "1"
+DASH_SKELETON_DELAY = float(os.environ.get("DASH_SKELETON_DELAY", "0.4"))
+DASH_EDIT_INTERVAL = float(os.environ.get("DASH_EDIT_INTERVAL", "1.0"))
+PENDING = "⏳ ..."
+
+class ResultCache:
+    """
+    Per-chat TTL cache for dashboard sections with single-flight loading:
+    callers that miss while a fetch for the same (chat_id, name) is running share its result.
+    Failed fetches are not cached; the last good value is served for up to
+    stale_ttl seconds past expiry while the upstream keeps failing.
+    """
+
+    def __init__(self, ttl=DASH_CACHE_TTL, max_chats=DASH_CACHE_MAX_CHATS, stale_ttl=DASH_STALE_TTL):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_chats = max_chats
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._inflight = {}
+        self._generation = {}
+
+    async def get_or_fetch(self, chat_id, name, factory):
+        entry = self._data.get(chat_id, {}).get(name)
+        if entry is not None and entry[0] > time.monotonic():
+            self.hits += 1
+            self._data.move_to_end(chat_id)
+            return entry[1]
+        self.misses += 1
+        key = (chat_id, name)
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._fetch(chat_id, name, factory))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+        try:
+            # Shielded so a caller timing out does not cancel the fetch other callers are waiting on.
+            return await asyncio.shield(task)
+        except TokenExpired:
+            raise
+        except Exception:
+            # Serve the last good value while the upstream is failing (e.g. circuit open).
+            if entry is not None and entry[0] + self.stale_ttl > time.monotonic():
+                logger.info(f"Serving stale {name} for {chat_id}")
+                return entry[1]
+            raise
+
+    def _done(self, key, task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            task.exception()  # mark retrieved; callers that are still waiting get it via shield
+
+    async def _fetch(self, chat_id, name, factory):
+        gen = self._generation.get(chat_id, 0)
+        value = await factory()
+        if self._generation.get(chat_id, 0) == gen:
+            self.put(chat_id, name, value)
+        return value
+
+    def put(self, chat_id, name, value, ttl=None):
+        if self.ttl <= 0: return
+        self._data.setdefault(chat_id, {})[name] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(chat_id)
+        while len(self._data) > self.max_chats:
+            old_chat, _ = self._data.popitem(last=False)
+            self._generation.pop(old_chat, None)
+
+    def invalidate(self, chat_id):
+        self._data.pop(chat_id, None)
+        self._generation[chat_id] = self._generation.get(chat_id, 0) + 1
+        for key in [k for k in self._inflight if k[0] == chat_id]:
+            del self._inflight[key]
+
+dash_cache = ResultCache()
+
+async def _section(name, fetch, chat_id, access, fallback):
+    # Each dashboard section times out and fails on its own. A 401 refreshes
+    # the token once (deduped across sections) and re-runs just this section.
+    for attempt in range(2):
+        try:
+            return await asyncio.wait_for(fetch(access), SECTION_TIMEOUT)
+        except TokenExpired:
+            if attempt: break
+            try:
+                access = await asyncio.wait_for(token_refresher.refresh_now(chat_id), SECTION_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.warning(f"Token refresh for dashboard section '{name}' timed out")
+                break
+            if not access: break
+        except asyncio.TimeoutError:
+            logger.warning(f"Dashboard section '{name}' timed out")
+            break
+        except Exception as e:
+            logger.warning(f"Dashboard section '{name}' failed: {e}")
+            break
+    return fallback
+
+def _dashboard_sections(chat_id, access, phone, instant_id, last_played_db, known_plan=None):
+    """Starts the plan, balance and gift fetches; returns {name: task}."""
+    async def load_plan(a):
+        async def fetch():
+            plan = await fetch_user_plan(a, phone, instant_id)
+            await update_user_plan(chat_id, plan)
+            return plan
+        return await dash_cache.get_or_fetch(chat_id, "plan", fetch)
+
+    def load_balance(a):
+        return dash_cache.get_or_fetch(chat_id, "balance", lambda: fetch_balance_bundles(a, phone, instant_id))
+
+    def load_gift(a):
+        # Pass DB value to cache function
+        return fetch_gift_info(chat_id, a, phone, instant_id, last_played_db)
+
+    if known_plan:
+        plan_task = asyncio.ensure_future(asyncio.sleep(0, result=known_plan))
+    else:
+        plan_task = asyncio.ensure_future(_section("plan", load_plan, chat_id, access, "Unknown"))
+    return {
+        "plan": plan_task,
+        "balance": asyncio.ensure_future(_section("balance", load_balance, chat_id, access, None)),
+        "gift": asyncio.ensure_future(_section("gift", load_gift, chat_id, access, ("❌ خطأ شبكة", False))),
+    }
+
+def _render_dashboard(phone, sections):
+    """Text and markup for whatever sections have finished; the rest show PENDING."""
+    def result(name, pending):
+        t = sections[name]
+        return t.result() if t.done() else pending
+
+    plan = result("plan", None)
+    balance = result("balance", PENDING)
+    gift_msg, can_claim = result("gift", (PENDING, False))
+    if can_claim:
+        # The claim button is about to be shown; have its nonce ready.
+        checkpoints.prefetch(normalize_msisdn(phone))
+
+    if balance is PENDING:
+        bal_msg = PENDING
+    else:
+        bal_msg = render_balance(balance) if balance is not None else "⚠️ فشل جلب الرصيد"
+    full_msg = _DASHBOARD(plan or PENDING, bal_msg, gift_msg)
 
-async def show_dashboard(update: Update, context, chat_id, access, phone, instant_id, last_played_db):
-    plan = await fetch_user_plan(access, phone, instant_id)
-    update_user_plan(chat_id, plan)
-    
-    bal_msg = await fetch_balance_bundles(access, phone, instant_id)
-    
-    # Pass DB value to cache function
-    gift_msg, can_claim = await fetch_gift_info(chat_id, access, phone, instant_id, last_played_db)
-    
-    full_msg = f"📱 **الخطة:** {plan}\n{bal_msg}\n" + "─" * 20 + f"\n{gift_msg}"
-    
     buttons = []
     if can_claim:
         buttons.append([InlineKeyboardButton("🎁 أحصل على الهدية الآن", callback_data="claim_gift")])
     if plan and plan.upper() == "YOOZ":
         buttons.append([InlineKeyboardButton("👻 التحقق من سناب شات", callback_data="check_snapchat")])
     buttons.append([InlineKeyboardButton("🔄 تحديث", callback_data="refresh_dash")])
-    
-    await update.message.reply_text(full_msg, reply_markup=InlineKeyboardMarkup(buttons), parse_mode='Markdown')
+    return full_msg, InlineKeyboardMarkup(buttons)
+
+async def build_dashboard(chat_id, access, phone, instant_id, last_played_db, known_plan=None):
+    """Fetches plan, balance and gift concurrently and returns (text, markup)."""
+    sections = _dashboard_sections(chat_id, access, phone, instant_id, last_played_db, known_plan)
+    await asyncio.wait(sections.values())
+    return _render_dashboard(phone, sections)
+
+async def stream_dashboard(send, chat_id, access, phone, instant_id, last_played_db, known_plan=None):
+    """
+    Progressive variant of build_dashboard. Waits DASH_SKELETON_DELAY for the
+    sections; if they all make it the dashboard goes out in a single send().
+    Otherwise a skeleton with what has arrived is sent and then edited as the
+    rest lands, at most one edit per DASH_EDIT_INTERVAL so bursts of results
+    coalesce into a single edit_message_text.
+    """
+    sections = _dashboard_sections(chat_id, access, phone, instant_id, last_played_db, known_plan)
+    _, pending = await asyncio.wait(sections.values(), timeout=DASH_SKELETON_DELAY)
+    text, markup = _render_dashboard(phone, sections)
+    msg = await send(text, markup)
+    last_edit = time.monotonic()
+    while pending:
+        _, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        hold = last_edit + DASH_EDIT_INTERVAL - time.monotonic()
+        if pending and hold > 0:
+            _, pending = await asyncio.wait(pending, timeout=hold)
+        new_text, markup = _render_dashboard(phone, sections)
+        if new_text == text and pending: continue
+        text = new_text
+        try:
+            await msg.edit_text(text, reply_markup=markup, parse_mode='Markdown')
+        except Exception as e:
+            logger.debug(f"Dashboard edit for {chat_id} failed: {e}")
+        last_edit = time.monotonic()
+
+async def show_dashboard(update: Update, context, chat_id, access, phone, instant_id, last_played_db):
+    async def send(text, markup):
+        return await update.effective_chat.send_message(text, reply_markup=markup, parse_mode='Markdown')
 
+    if DASH_STREAM:
+        await stream_dashboard(send, chat_id, access, phone, instant_id, last_played_db)
+    else:
+        await send(*await build_dashboard(chat_id, access, phone, instant_id, last_played_db))
+
+@instrumented
 async def refresh_dashboard(update: Update, context):
     q = update.callback_query
     await q.answer("جاري التحديث...")
     chat_id = update.effective_chat.id
-    u = get_user_data(chat_id)
-    if not u: return
+    u = await get_user_data(chat_id)
+    if not u or not u.access_token: return
     
-    plan = u['plan_type'] or await fetch_user_plan(u['access_token'], u['phone_number'], u['instant_id'])
-    bal_msg = await fetch_balance_bundles(u['access_token'], u['phone_number'], u['instant_id'])
     # Pass last_played_time from DB to use cache
-    gift_msg, can_claim = await fetch_gift_info(chat_id, u['access_token'], u['phone_number'], u['instant_id'], u['last_played_time'])
-    
-    full_msg = f"📱 **الخطة:** {plan}\n{bal_msg}\n" + "─" * 20 + f"\n{gift_msg}"
-    
-    buttons = []
-    if can_claim: buttons.append([InlineKeyboardButton("🎁 أحصل على الهدية الآن", callback_data="claim_gift")])
-    if plan and plan.upper() == "YOOZ": buttons.append([InlineKeyboardButton("👻 التحقق من سناب شات", callback_data="check_snapchat")])
-    buttons.append([InlineKeyboardButton("🔄 تحديث", callback_data="refresh_dash")])
+    full_msg, markup = await build_dashboard(chat_id, u.access_token, u.phone_number, u.instant_id,
+                                             u.last_played_time, known_plan=u.plan_type)
     
     try:
-        await q.edit_message_text(full_msg, reply_markup=InlineKeyboardMarkup(buttons), parse_mode='Markdown')
+        await q.edit_message_text(full_msg, reply_markup=markup, parse_mode='Markdown')
     except:
         pass
 
 # --- GAME PLAY LOGIC ---
 
+@instrumented
 async def claim_gift(update: Update, context):
     q = update.callback_query
     await q.answer()
-    await q.edit_message_text("⏳ جاري تحضير الهدية (الخطوة 1/2)...")
     
     chat_id = update.effective_chat.id
-    u = get_user_data(chat_id)
-    if not u: return
-    
-    phone = u['phone_number']
-    if phone.startswith("05"): phone = "213" + phone[1:]
+    u = await get_user_data(chat_id)
+    if not u or not u.access_token: return
     
-    # 1. CHECKPOINT Request (To get Nonce/Chronos for Play)
-    headers_cp = {
-        "X-msisdn": phone,
-        "X-platform-origin": "mobile-android",
-        "X-path": "/api/auth/realms/myooredoo/protocol/openid-connect/token", 
-        "X-method": "POST"
-    }
+    phone = normalize_msisdn(u.phone_number)
     
-    try:
-        r1 = requests.post(URL_CHECKPOINT, headers=headers_cp)
-        if r1.status_code == 202:
-            nonce = r1.headers.get("X-Nonce-Id")
-            chronos = r1.headers.get("X-Chronos-Id")
-        else:
-            await update.effective_chat.send_message(f"❌ فشل التحضير ({r1.status_code})")
-            return
-    except Exception as e:
-        await update.effective_chat.send_message(f"❌ خطأ اتصال: {str(e)}")
+    # 1. CHECKPOINT Request (To get Nonce/Chronos for Play), usually prefetched with the dashboard
+    if not checkpoints.ready(phone):
+        await q.edit_message_text("⏳ جاري تحضير الهدية (الخطوة 1/2)...")
+    sec = await checkpoints.take(phone)
+    if not sec["ok"]:
+        await update.effective_chat.send_message(f"❌ فشل التحضير:\n{sec.get('err')}")
         return
+    nonce, chronos = sec["nonce"], sec["chronos"]
 
     # 2. PLAY Request
     await q.edit_message_text("⏳ جاري فتح الهدية (الخطوة 2/2)...")
     
-    headers_play = get_headers_verified(u['access_token'], phone, u['instant_id'])
+    headers_play = get_headers_verified(u.access_token, phone, u.instant_id)
     
     headers_play.update({
         "X-Nonce-Id": nonce,
         "X-Chronos-Id": chronos,
-        "X-platform-origin": "mobile-android"
     })
     
     try:
-        r2 = requests.post(URL_GIFT_PLAY, headers=headers_play)
+        r2 = await api.post(URL_GIFT_PLAY, headers=headers_play)
         
+        if r2.status_code == 401:
+            if await token_refresher.refresh_now(chat_id):
+                await update.effective_chat.send_message("🔄 تم تجديد الجلسة، اضغط على الهدية مرة أخرى.")
+            else:
+                await update.effective_chat.send_message("❌ انتهت الجلسة، أرسل /start لتسجيل الدخول.")
+            return
+
         if r2.status_code == 200:
-            data = r2.json()
-            gift_name = data.get("giftName", "هدية")
-            validity = data.get("validityHour", "?")
-            played_time = data.get("playedTime") 
+            result = PlayResult.from_json(decode(r2))
             
-            if played_time:
-                update_last_played(chat_id, played_time)
+            if result.played_time:
+                await update_last_played(chat_id, result.played_time)
+            dash_cache.invalidate(chat_id)
             
-            msg = f"🎉 **مبروك! حصلت على:**\n\n🎁 {gift_name}\n⏳ الصلاحية: {validity} ساعة"
+            msg = f"🎉 **مبروك! حصلت على:**\n\n🎁 {result.gift_name}\n⏳ الصلاحية: {result.validity} ساعة"
             
             await update.effective_chat.send_message(msg, parse_mode='Markdown')
             
-            u_new = get_user_data(chat_id)
-            await show_dashboard(update, context, chat_id, u_new['access_token'], u_new['phone_number'], u_new['instant_id'], u_new['last_played_time'])
+            u_new = await get_user_data(chat_id)
+            await show_dashboard(update, context, chat_id, u_new.access_token, u_new.phone_number, u_new.instant_id, u_new.last_played_time)
             
         else:
             await update.effective_chat.send_message(f"❌ خطأ أثناء الفتح ({r2.status_code}):\n{r2.text[:50]}")
@@ -465,33 +1676,403 @@ async def claim_gift(update: Update, context):
     except Exception as e:
         await update.effective_chat.send_message(f"❌ خطأ: {str(e)}")
 
+@instrumented
 async def check_snapchat(update: Update, context):
     q = update.callback_query
     await q.answer()
     await q.message.reply_text("👻 التحقق من سناب شات (قيد التنفيذ)...")
 
 
+# --- ADMIN SWEEP ---
+ADMIN_CHAT_IDS = {int(x) for x in os.environ.get("ADMIN_CHAT_IDS", "").replace(" ", "").split(",") if x}
+SWEEP_BATCH = int(os.environ.get("SWEEP_BATCH", "200"))
+SWEEP_CONCURRENCY = int(os.environ.get("SWEEP_CONCURRENCY", "8"))
+SWEEP_RATE = float(os.environ.get("SWEEP_RATE", "5"))
+
+class Sweeper:
+    """
+    Refreshes plan, balance and gift status for every logged-in user.
+    Users are streamed from SQLite in chat_id order, processed by a bounded worker
+    pool under a global rate limit (users/s), and written back one transaction per
+    batch together with the resume cursor, so a crashed sweep continues where it stopped.
+    """
+
+    name = "users"
+
+    def __init__(self, batch=SWEEP_BATCH, concurrency=SWEEP_CONCURRENCY, rate=SWEEP_RATE):
+        self.batch = batch
+        self.concurrency = concurrency
+        self.bucket = TokenBucket(rate, max(1.0, rate))
+        self.task = None
+
+    async def _refresh_user(self, chat_id, phone, access, instant_id, updates, counts):
+        await self.bucket.acquire()
+        try:
+            plan, balance, gift = await asyncio.gather(
+                fetch_user_plan(access, phone, instant_id),
+                fetch_balance_bundles(access, phone, instant_id),
+                fetch_gift_status(access, phone, instant_id),
+            )
+        except TokenExpired:
+            counts["expired"] += 1
+            return
+        except Exception as e:
+            counts["failed"] += 1
+            logger.debug(f"Sweep failed for {chat_id}: {e}")
+            return
+        cols = {"plan_type": plan}
+        if gift.played and gift.last_played:
+            cols["last_played_time"] = gift.last_played
+            gift_scheduler.note_played(chat_id, gift.last_played)
+        updates[chat_id] = cols
+        user_cache.update(chat_id, **cols)
+        dash_cache.put(chat_id, "plan", plan)
+        dash_cache.put(chat_id, "balance", balance)
+
+    async def run(self, report=None, restart=False, report_every=10.0):
+        if restart:
+            await db.execute(SQL_SWEEP_DELETE, (self.name,))
+        row = await db.run(db._sweep_progress, self.name)
+        cursor, processed, failed, expired = row or (0, 0, 0, 0)
+        if row:
+            logger.info(f"Resuming sweep after chat_id {cursor} ({processed} done)")
+        started = time.monotonic()
+        done_this_run = 0
+        last_report = started
+        sem = asyncio.Semaphore(self.concurrency)
+
+        async def worker(user, updates, counts):
+            async with sem:
+                await self._refresh_user(*user, updates, counts)
+
+        while True:
+            users = await db.run(db._sweep_batch, cursor, self.batch)
+            if not users: break
+            updates, counts = {}, {"failed": 0, "expired": 0}
+            await asyncio.gather(*(worker(u, updates, counts) for u in users))
+            cursor = users[-1][0]
+            processed += len(users)
+            failed += counts["failed"]
+            expired += counts["expired"]
+            done_this_run += len(users)
+            await db.run(db._commit_sweep_batch, updates, (self.name, cursor, processed, failed, expired))
+            now = time.monotonic()
+            if report and now - last_report >= report_every:
+                last_report = now
+                await report(self.summary(processed, failed, expired, done_this_run / (now - started)))
+
+        await db.execute(SQL_SWEEP_DELETE, (self.name,))
+        elapsed = time.monotonic() - started
+        summary = self.summary(processed, failed, expired, done_this_run / elapsed if elapsed else 0.0, final=True)
+        logger.info(summary)
+        if report: await report(summary)
+        return summary
+
+    @staticmethod
+    def summary(processed, failed, expired, rate, final=False):
+        head = "✅ اكتمل المسح" if final else "⏳ جاري المسح"
+        return f"{head}\nمعالج: {processed}\nفشل: {failed}\nجلسات منتهية: {expired}\nالسرعة: {rate:.1f} مستخدم/ث"
+
+sweeper = Sweeper()
+
+@instrumented
+async def sweep_command(update: Update, context):
+    chat_id = update.effective_chat.id
+    if chat_id not in ADMIN_CHAT_IDS:
+        return
+    if sweeper.task is not None and not sweeper.task.done():
+        await update.message.reply_text("⏳ المسح قيد التنفيذ بالفعل.")
+        return
+    restart = bool(context.args) and context.args[0] == "restart"
+    status = await update.message.reply_text("⏳ بدء المسح...")
+
+    async def report(text):
+        try:
+            await status.edit_text(text)
+        except Exception as e:
+            logger.debug(f"Sweep progress edit failed: {e}")
+
+    sweeper.task = asyncio.create_task(sweeper.run(report, restart=restart))
+
+async def run_sweep_cli(restart=False):
+    init_db()
+    async def report(text):
+        logger.info(text.replace("\n", " | "))
+    try:
+        await sweeper.run(report, restart=restart)
+    finally:
+        await api.aclose()
+        db.close()
+
+# --- WARM RESTART ---
+# Empty SNAPSHOT_PATH disables snapshots; older ones are ignored.
+SNAPSHOT_PATH = os.environ.get("SNAPSHOT_PATH", os.path.join(os.path.dirname(DBNAME), "warm.snapshot"))
+SNAPSHOT_MAX_AGE = float(os.environ.get("SNAPSHOT_MAX_AGE", "900"))
+# Any change to the persisted model layouts invalidates old snapshots.
+SNAPSHOT_VERSION = f"3:{','.join(Balance.__slots__)}:{','.join(Bundle.__slots__)}"
+
+def _dump_section(name, value):
+    # Dashboard results are stored as plain tuples, never as model instances.
+    if name == "balance" and value is not None:
+        return (value.amount, tuple(tuple(getattr(b, f) for f in Bundle.__slots__) for b in value.bundles))
+    return value
+
+def _load_section(name, value):
+    if name == "balance" and value is not None:
+        amount, bundles = value
+        return Balance(amount, tuple(Bundle(*b) for b in bundles))
+    return value
+
+class WarmState:
+    """
+    Writes the hot caches (which users were cached, dashboard results,
+    prefetched checkpoints, signer clock offset) to one JSON file on graceful
+    shutdown and feeds them back in the background on the next boot. User rows,
+    credentials included, are re-read from the database in a few batched
+    queries, and schedules are always rebuilt from it. Monotonic expiries are
+    stored as wall-clock times and re-checked on restore; anything already
+    present in memory wins over the snapshot. The file is removed once read so
+    a crash never restores the same state twice.
+    """
+
+    def __init__(self, path=SNAPSHOT_PATH, max_age=SNAPSHOT_MAX_AGE):
+        self.path = path
+        self.max_age = max_age
+        self.restored = {}
+        self.task = None
+
+    def capture(self):
+        now, mono = time.time(), time.monotonic()
+        dash = {chat_id: {name: (now + exp - mono, _dump_section(name, value)) for name, (exp, value) in sections.items()}
+                for chat_id, sections in dash_cache._data.items()}
+        pending = [(key, now - (mono - created), task.result()) for key, (created, task) in checkpoints._slots.items()
+                   if task.done() and not task.cancelled() and task.exception() is None and task.result()["ok"]]
+        return {
+            "version": SNAPSHOT_VERSION,
+            "saved_at": now,
+            # LRU order, oldest first, so re-inserting keeps the hot end hot.
+            "users": list(user_cache._data),
+            "dash": dash,
+            "checkpoints": pending,
+            "clock": (signer.offset_ms, signer.samples),
+        }
+
+    def _write(self, state):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f, separators=(",", ":"), ensure_ascii=False)
+        os.replace(tmp, self.path)
+
+    def _read(self):
+        try:
+            with open(self.path, "rb") as f:
+                state = json_loads(f.read())
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable snapshot {self.path}: {e}")
+            state = None
+        finally:
+            try: os.remove(self.path)
+            except OSError: pass
+        if not isinstance(state, dict) or state.get("version") != SNAPSHOT_VERSION:
+            return None
+        if time.time() - state["saved_at"] > self.max_age:
+            logger.info("Snapshot too old, starting cold")
+            return None
+        return state
+
+    async def save(self):
+        if not self.path: return
+        try:
+            state = self.capture()
+            await asyncio.to_thread(self._write, state)
+            logger.info(f"Snapshot saved: {len(state['users'])} users, {len(state['dash'])} dashboards")
+        except Exception as e:
+            logger.warning(f"Snapshot save failed: {e}")
+
+    async def apply(self, state):
+        users = 0
+        for rec in await db.run(db._get_users, state["users"]):
+            if user_cache._data.get(rec.chat_id) is None:
+                user_cache.put(write_queue.overlay(rec.chat_id, rec))
+                users += 1
+        now, mono = time.time(), time.monotonic()
+        dash = 0
+        for chat_key, sections in state["dash"].items():
+            chat_id = int(chat_key)  # JSON object keys are strings
+            for name, (expires, value) in sections.items():
+                # Expired entries are still worth keeping while they can be served stale.
+                if expires + dash_cache.stale_ttl > now and name not in dash_cache._data.get(chat_id, {}):
+                    dash_cache.put(chat_id, name, _load_section(name, value), ttl=expires - now)
+                    dash += 1
+        for key, created, result in state["checkpoints"]:
+            key = tuple(key)
+            if now - created < checkpoints.ttl and key not in checkpoints._slots:
+                fut = asyncio.get_running_loop().create_future()
+                fut.set_result(result)
+                checkpoints._slots[key] = (mono - (now - created), fut)
+        if signer.samples == 0:
+            signer.offset_ms, signer.samples = state["clock"]
+        self.restored = {"users": users, "dash": dash}
+        logger.info(f"Snapshot restored: {self.restored}")
+
+    async def _restore(self, load_gifts):
+        state = await asyncio.to_thread(self._read) if self.path else None
+        if state is not None:
+            await self.apply(state)
+        # A refresh in flight at shutdown is in neither the heap nor a snapshot,
+        # so the schedules always come from the (indexed) database.
+        await token_refresher.load()
+        if load_gifts:
+            await gift_scheduler.load()
+
+    def start(self, load_gifts):
+        if self.task is None:
+            self.task = asyncio.create_task(self._restore(load_gifts))
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+warm_state = WarmState()
+
+# --- STATUS SERVER ---
+HEALTH_PORT = int(os.environ.get("HEALTH_PORT", "8081"))
+
+class StatusServer:
+    """Tiny HTTP server for health checks, separate from the Telegram webhook."""
+
+    def __init__(self, port=HEALTH_PORT):
+        self.port = port
+        self.routes = {"/healthz": self._health, "/metrics": self._metrics}
+        self._server = None
+
+    @staticmethod
+    def _health():
+        return 200, "text/plain", b"ok\n"
+
+    @staticmethod
+    def _metrics():
+        return 200, "text/plain; version=0.0.4", metrics.render()
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5)
+            while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode("latin-1").split()
+            path = parts[1].split("?")[0] if len(parts) > 1 else "/"
+            route = self.routes.get(path)
+            status, ctype, body = route() if route else (404, "text/plain", b"not found\n")
+            reason = {200: "OK", 404: "Not Found"}.get(status, "")
+            writer.write(f"HTTP/1.1 {status} {reason}\r\nContent-Type: {ctype}\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except Exception as e:
+            logger.debug(f"Status request failed: {e}")
+        finally:
+            writer.close()
+
+    async def start(self):
+        if self.port:
+            self._server = await asyncio.start_server(self._handle, "0.0.0.0", self.port)
+            logger.info(f"Status server listening on :{self.port}")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+status_server = StatusServer()
+
+def _cache_samples(attr):
+    caches = {"user": user_cache, "dashboard": dash_cache, "checkpoint": checkpoints}
+    return [((name,), getattr(c, attr)) for name, c in caches.items()]
+
+metrics.add(CallbackMetric("ooredoo_cache_hits_total", "Cache hits.", "counter", ("cache",),
+                           lambda: _cache_samples("hits")))
+metrics.add(CallbackMetric("ooredoo_cache_misses_total", "Cache misses.", "counter", ("cache",),
+                           lambda: _cache_samples("misses")))
+metrics.add(CallbackMetric("ooredoo_user_cache_bytes", "Approximate size of the user cache.", "gauge", (),
+                           lambda: [((), user_cache.bytes)]))
+metrics.add(CallbackMetric("ooredoo_write_queue_pending", "Users with unflushed writes.", "gauge", (),
+                           lambda: [((), len(write_queue.pending))]))
+metrics.add(CallbackMetric("ooredoo_circuit_open", "1 while an endpoint's circuit is not closed.", "gauge", ("endpoint",),
+                           lambda: [((b.name,), int(b.state != "closed")) for b in api.breakers.values()]))
+
+# --- UPDATE DISPATCH ---
+UPDATE_CONCURRENCY = int(os.environ.get("UPDATE_CONCURRENCY", "16"))
+UPDATE_BACKLOG = int(os.environ.get("UPDATE_BACKLOG", "256"))
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    Runs updates from different chats concurrently (up to `concurrency` at once)
+    while updates from the same chat run one at a time, in arrival order.
+
+    PTB's own semaphore only bounds how many updates are in flight (`backlog`);
+    the concurrency slot is taken after the chat lock so updates queued behind
+    a busy chat do not hold slots other chats could use.
+    """
+
+    def __init__(self, concurrency=UPDATE_CONCURRENCY, backlog=UPDATE_BACKLOG):
+        super().__init__(max(backlog, concurrency))
+        self._active = asyncio.Semaphore(concurrency)
+        self._chats = {}
+
+    async def do_process_update(self, update, coroutine):
+        chat = getattr(update, "effective_chat", None)
+        if chat is None:
+            async with self._active:
+                await coroutine
+            return
+        # [lock, users]; dropped as soon as nobody holds or waits for it.
+        entry = self._chats.get(chat.id)
+        if entry is None:
+            entry = self._chats[chat.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0], self._active:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._chats[chat.id]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
 # --- MAIN ---
-user_states = {}
 
+@instrumented
 async def start(update: Update, context):
     chat_id = update.effective_chat.id
-    get_or_create_device_info(chat_id)
-    u = get_user_data(chat_id)
+    await get_or_create_device_info(chat_id)
+    u = await get_user_data(chat_id)
     
-    if u and u['access_token']:
+    if u and u.access_token:
         await update.message.reply_text("👋 مرحبًا بك مجددًا!")
-        await show_dashboard(update, context, chat_id, u['access_token'], u['phone_number'], u['instant_id'], u['last_played_time'])
+        await show_dashboard(update, context, chat_id, u.access_token, u.phone_number, u.instant_id, u.last_played_time)
     else:
-        user_states[chat_id] = "phone"
+        await conv_states.set(chat_id, "phone")
+        if u and u.phone_number:
+            # Returning user whose session ended: they will most likely re-enter the same number.
+            checkpoints.prefetch(u.phone_number, u.device_uuid)
         await update.message.reply_text("📞 رقم الهاتف:")
 
+@instrumented
 async def handle_msg(update: Update, context):
     chat_id = update.effective_chat.id
     txt = update.message.text.strip()
-    state = user_states.get(chat_id)
+    state = await conv_states.get(chat_id)
     
-    device_uid, instant_id = get_or_create_device_info(chat_id)
+    device_uid, instant_id = await get_or_create_device_info(chat_id)
     
     if state == "phone":
         if txt.startswith("05"): txt = "213" + txt[1:]
@@ -500,21 +2081,22 @@ async def handle_msg(update: Update, context):
             await update.message.reply_text("❌ تنسيق الرقم خطأ (05...).")
             return
 
-        sec = await request_checkpoint(txt, device_uid)
+        sec = await checkpoints.take(txt, device_uid)
         if not sec["ok"]:
              await update.message.reply_text(f"❌ فشل الاتصال:\n{sec.get('err')}")
              return
              
         res = await send_otp_request(txt, sec["nonce"], sec["chronos"], device_uid)
         if res["ok"]:
-            user_states[chat_id] = {"st": "otp", "ph": txt}
+            await conv_states.set(chat_id, {"st": "otp", "ph": txt})
+            checkpoints.prefetch(txt, device_uid)
             await update.message.reply_text("✅ تم إرسال الرمز! أدخل OTP:")
         else:
             await update.message.reply_text(f"❌ فشل الإرسال:\n{res.get('err')}")
             
     elif isinstance(state, dict) and state["st"] == "otp":
         ph = state["ph"]
-        sec = await request_checkpoint(ph, device_uid)
+        sec = await checkpoints.take(ph, device_uid)
         if not sec["ok"]:
             await update.message.reply_text(f"❌ فشل تحديث الجلسة:\n{sec.get('err')}")
             return
@@ -522,25 +2104,62 @@ async def handle_msg(update: Update, context):
         res = await verify_otp_request(ph, txt, sec["nonce"], sec["chronos"], device_uid)
         
         if res["ok"]:
-            save_user_data(chat_id, ph, res["access"], res["refresh"], 3600)
-            user_states[chat_id] = None
+            await save_user_data(chat_id, ph, res["access"], res["refresh"], res["expires"])
+            await conv_states.set(chat_id, None)
             await update.message.reply_text("✅ **تم تسجيل الدخول!**", parse_mode='Markdown')
             
-            u_new = get_user_data(chat_id)
-            await show_dashboard(update, context, chat_id, res["access"], ph, instant_id, u_new['last_played_time'])
+            u_new = await get_user_data(chat_id)
+            await show_dashboard(update, context, chat_id, res["access"], ph, instant_id, u_new.last_played_time)
         else:
             await update.message.reply_text(f"❌ رمز خاطئ:\n{res.get('err')}")
 
+async def on_startup(app):
+    await status_server.start()
+    loop_lag.start()
+    write_queue.start()
+    conv_states.start()
+    # Schedules and caches fill in from the snapshot (or the database) in the background.
+    warm_state.start(load_gifts=GIFT_NOTIFY)
+    token_refresher.start()
+    if GIFT_NOTIFY:
+        gift_scheduler.start(app.bot)
+
+async def on_shutdown(app):
+    if sweeper.task is not None:
+        sweeper.task.cancel()
+        await asyncio.gather(sweeper.task, return_exceptions=True)
+    await warm_state.stop()
+    await gift_scheduler.stop()
+    await token_refresher.stop()
+    await api.aclose()
+    await write_queue.stop()
+    await warm_state.save()
+    await conv_states.stop()
+    db.close()
+    await loop_lag.stop()
+    await status_server.stop()
+
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "sweep":
+        asyncio.run(run_sweep_cli(restart="--restart" in sys.argv))
+        return
     init_db()
-    app = Application.builder().token(TELEGRAMBOTTOKEN).build()
+    app = (Application.builder().token(TELEGRAMBOTTOKEN)
+           .concurrent_updates(PerChatUpdateProcessor())
+           .post_init(on_startup).post_shutdown(on_shutdown).build())
     app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("sweep", sweep_command))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_msg))
     app.add_handler(CallbackQueryHandler(claim_gift, pattern="^claim_gift$"))
     app.add_handler(CallbackQueryHandler(check_snapchat, pattern="^check_snapchat$"))
     app.add_handler(CallbackQueryHandler(refresh_dashboard, pattern="^refresh_dash$"))
-    print("Bot Running...")
-    app.run_polling()
+    if BOT_MODE == "webhook":
+        print(f"Bot Running (webhook on :{PORT})...")
+        app.run_webhook(listen="0.0.0.0", port=PORT, url_path=WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                        webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}")
+    else:
+        print("Bot Running...")
+        app.run_polling()
 
 if __name__ == "__main__":
     main()